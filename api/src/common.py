@@ -0,0 +1,143 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+import time
+import random
+import asyncio
+import hmac
+import hashlib
+from typing import Optional
+import replicate
+import aiohttp
+import aiofiles
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Credentials, read once per process
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
+MUX_TOKEN_ID = os.getenv("MUX_TOKEN_ID", "")
+MUX_TOKEN_SECRET = os.getenv("MUX_TOKEN_SECRET", "")
+
+# Replicate client, built once per process
+REPLICATE = replicate.Client(api_token=REPLICATE_API_TOKEN)
+# Cap on concurrent Replicate predictions, so bursts queue here instead of hitting 429s
+REPLICATE_SEM = asyncio.Semaphore(int(os.getenv("REPLICATE_MAX_INFLIGHT", "4")))
+
+# Model identifiers and the MusicGen settings shared by every endpoint
+MUSICGEN_MODEL = "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906"
+MUSICGEN_INPUT = {
+    "model_version": "large",
+    "duration": 10,
+    "temperature": 0.7,
+    "top_k": 250,
+    "top_p": 0.99,
+    "classifier_free_guidance": 3,
+    "output_format": "mp3"
+}
+VIZ_MODEL = "luma/ray"
+
+# When set, asset readiness arrives via the Mux webhook instead of polling
+MUX_WEBHOOK_SECRET = os.getenv("MUX_WEBHOOK_SECRET", "")
+# Webhooks signed further than this from now are rejected as replays
+MUX_WEBHOOK_TOLERANCE = 300
+
+# Log records go through a queue so the stdout writes happen on the
+# listener's thread instead of in request handlers and upload workers
+log_queue = queue.SimpleQueue()
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S"))
+log_listener = logging.handlers.QueueListener(log_queue, stdout_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+# Only the app's own logger is configured; the root logger is left alone so
+# third-party INFO logs (httpx logs every request) stay off
+logger = logging.getLogger("tiktok2")
+logger.setLevel(logging.INFO)
+logger.addHandler(queue_handler)
+logger.propagate = False
+
+def log(message: str) -> None:
+    """Simple logging with timestamp."""
+    logger.info(message)
+
+async def run_prediction(ref: str, input: dict):
+    """Run a Replicate model and poll it with capped exponential backoff plus jitter."""
+    async with REPLICATE_SEM:
+        if ":" in ref:
+            prediction = await REPLICATE.predictions.async_create(version=ref.split(":", 1)[1], input=input)
+        else:
+            prediction = await REPLICATE.models.predictions.async_create(model=ref, input=input)
+        
+        attempt = 0
+        while prediction.status not in ("succeeded", "failed", "canceled"):
+            await asyncio.sleep(min(5.0, 0.2 * (2 ** attempt)) + random.uniform(0, 0.2))
+            attempt += 1
+            prediction = await REPLICATE.predictions.async_get(prediction.id)
+    
+    if prediction.status != "succeeded":
+        raise Exception(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+    return prediction.output
+
+def verify_mux_signature(body: bytes, header: str) -> bool:
+    """Check a Mux-Signature header (t=<timestamp>,v1=<hmac>) against the body."""
+    parts = dict(part.split("=", 1) for part in header.split(",") if "=" in part)
+    if "t" not in parts or "v1" not in parts:
+        return False
+    try:
+        if abs(time.time() - int(parts["t"])) > MUX_WEBHOOK_TOLERANCE:
+            return False
+    except ValueError:
+        return False
+    expected = hmac.new(MUX_WEBHOOK_SECRET.encode(), f"{parts['t']}.".encode() + body,
+                        hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, parts["v1"])
+
+# Shared HTTP session for downloads, opened on startup
+http_session: Optional[aiohttp.ClientSession] = None
+
+async def open_http_session() -> None:
+    """Open the pooled HTTP session used for downloads."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, limit_per_host=8, keepalive_timeout=60)
+        )
+
+async def close_http_session() -> None:
+    """Close the pooled HTTP session."""
+    if http_session:
+        await http_session.close()
+
+async def download_file(url: str, local_filename: str) -> str:
+    """Stream a file from a URL to a local file without blocking the event loop."""
+    log(f"📥 Downloading from {url}")
+    try:
+        async with http_session.get(url) as response:
+            response.raise_for_status()
+            total_size = response.content_length or 0
+            if total_size == 0:
+                log("⚠️ Content length header missing, cannot track progress")
+
+            async with aiofiles.open(local_filename, 'wb') as f:
+                downloaded = 0
+                last_logged = time.monotonic()
+                async for chunk in response.content.iter_chunked(65536):
+                    await f.write(chunk)
+                    downloaded += len(chunk)
+                    # Report progress at most twice a second
+                    if total_size and time.monotonic() - last_logged >= 0.5:
+                        last_logged = time.monotonic()
+                        log(f"Download progress: {(downloaded / total_size) * 100:.1f}%")
+
+        log(f"✅ Successfully downloaded to {local_filename}")
+        return local_filename
+    except Exception as e:
+        log(f"❌ Download failed: {str(e)}")
+        raise
@@ -1,27 +1,29 @@
 import os
-import json
 import time
 import asyncio
 import tempfile
-from datetime import datetime
-from typing import Optional
-from fastapi import FastAPI, HTTPException
+from typing import AsyncIterator, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import replicate
-import mux_python
+from pydantic import BaseModel, ConfigDict
+import orjson
 import ffmpeg
-import requests
-from dotenv import load_dotenv
+import httpx
+from common import (
+    run_prediction, MUSICGEN_MODEL, MUSICGEN_INPUT, VIZ_MODEL,
+    MUX_TOKEN_ID, MUX_TOKEN_SECRET, MUX_WEBHOOK_SECRET, verify_mux_signature,
+    log, download_file, open_http_session, close_http_session
+)
 
-# Load environment variables
-load_dotenv()
+MUX_WEBHOOK_TIMEOUT = 180
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Peaceful Meditation API",
     description="API for AI-powered meditation music and peaceful video generation",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -33,13 +35,36 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
+# Shared client for the Mux API, opened on startup
+mux_client: Optional[httpx.AsyncClient] = None
+
+# Uploads waiting on a video.asset.ready webhook, keyed by upload ID
+asset_waiters: dict[str, asyncio.Future] = {}
+
+@app.on_event("startup")
+async def open_http_clients() -> None:
+    """Open the pooled HTTP clients used for downloads and the Mux API."""
+    global mux_client
+    await open_http_session()
+    mux_client = httpx.AsyncClient(
+        base_url="https://api.mux.com",
+        auth=(MUX_TOKEN_ID, MUX_TOKEN_SECRET),
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+
+@app.on_event("shutdown")
+async def close_http_clients() -> None:
+    """Close the pooled HTTP clients."""
+    await close_http_session()
+    if mux_client:
+        await mux_client.aclose()
 
 class GenerationResponse(BaseModel):
     """Response model for the combined generation endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     mux_playback_id: Optional[str] = None
     mux_playback_url: Optional[str] = None
@@ -49,167 +74,120 @@ class GenerationResponse(BaseModel):
 
 class GenerationRequest(BaseModel):
     """Request model for the combined generation endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     vibe: str
     heart_rate: int
     intensity: float
 
-async def generate_music() -> str:
-    """Generate peaceful meditation music using Meta's MusicGen model."""
-    log("🎵 Starting music generation")
-    
-    input_params = {
-        "model_version": "large",
-        "prompt": "calming lofi beats, peaceful ambient meditation music, no lyrics, soft piano and strings",
-        "duration": 10,
-        "temperature": 0.7,
-        "top_k": 250,
-        "top_p": 0.99,
-        "classifier_free_guidance": 3,
-        "output_format": "mp3"
-    }
-    log(f"Music generation parameters: {json.dumps(input_params, indent=2)}")
-    
-    output = replicate.run(
-        "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-        input=input_params
-    )
-    
-    if isinstance(output, list) and len(output) > 0:
-        output_url = str(output[0])
-    else:
-        output_url = str(output)
-    
-    log(f"✅ Music generated: {output_url}")
-    return output_url
+async def probe_duration(path: str) -> float:
+    """Read a media file's duration in seconds with ffprobe."""
+    probe = await asyncio.to_thread(ffmpeg.probe, path)
+    return float(probe["format"]["duration"])
 
-async def generate_visualization() -> str:
-    """Generate peaceful visualization using Luma Ray."""
-    log("🎬 Starting visualization generation")
-    
-    input_params = {
-        "prompt": "beautiful abstract peaceful animation, soft flowing colors, gentle transitions, meditative visuals",
-        "negative_prompt": "text, watermark, ugly, distorted, noisy",
-        "fps": 30,
-        "num_frames": 90,
-        "guidance_scale": 7.5,
-        "num_inference_steps": 50,
-        "width": 512,
-        "height": 512,
-        "scheduler": "DPM++ Karras SDE"
-    }
-    log(f"Visualization parameters: {json.dumps(input_params, indent=2)}")
+async def merge_and_loop(video_path: str, audio_path: str, loops: int = 5) -> AsyncIterator[bytes]:
+    """Merge audio and video and loop the result, yielding the MP4 as FFmpeg writes it."""
+    log("🔄 Starting merge and loop process")
     
-    output = replicate.run(
-        "luma/ray",
-        input=input_params
+    # Merging with -shortest and then looping repeats a clip cut to the shorter
+    # track, so the audio restarts with the video on every loop. Each input is
+    # repeated through the concat demuxer with an outpoint at that length,
+    # which gives the same result without the intermediate file. Both tracks
+    # are stream-copied (Luma Ray returns H.264, MusicGen returns MP3, and
+    # MP3-in-MP4 is valid), so this is a remux. Fragmented MP4 can be written
+    # to a pipe since it never seeks back.
+    segment = min(await asyncio.gather(probe_duration(video_path), probe_duration(audio_path)))
+    inputs = []
+    for path in (video_path, audio_path):
+        playlist = f"{path}.loop.txt"
+        with open(playlist, "w") as f:
+            f.write(f"file '{os.path.abspath(path)}'\noutpoint {segment}\n" * loops)
+        inputs.append(ffmpeg.input(playlist, format='concat', safe=0))
+    
+    stream = ffmpeg.output(*inputs, 'pipe:1',
+                         format='mp4',
+                         acodec='copy',
+                         vcodec='copy',
+                         shortest=None,
+                         movflags='frag_keyframe+empty_moov',
+                         loglevel='error')
+    proc = await asyncio.create_subprocess_exec(
+        *ffmpeg.compile(stream),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
     )
     
-    output_url = str(output)
-    log(f"✅ Visualization generated: {output_url}")
-    return output_url
+    try:
+        while chunk := await proc.stdout.read(1024 * 1024):
+            yield chunk
+        stderr = await proc.stderr.read()
+        if await proc.wait() != 0:
+            raise ffmpeg.Error('ffmpeg', None, stderr)
+    finally:
+        # Don't leave FFmpeg running if the consumer gave up early
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    
+    log("✅ Merge and loop complete")
 
-async def download_file(url: str, local_filename: str) -> str:
-    """Download a file from a URL to a local file with progress logging."""
-    log(f"📥 Downloading from {url}")
-    
-    response = requests.get(url, stream=True)
+async def mux_request(method: str, path: str, **kwargs) -> dict:
+    """Call the Mux REST API over the shared client and return its `data` payload."""
+    response = await mux_client.request(method, path, **kwargs)
     response.raise_for_status()
-    total_size = int(response.headers.get('content-length', 0))
-    
-    with open(local_filename, 'wb') as f:
-        if total_size == 0:
-            log("⚠️ Content length header missing, cannot track progress")
-        
-        downloaded = 0
-        for chunk in response.iter_content(chunk_size=8192):
-            f.write(chunk)
-            downloaded += len(chunk)
-            if total_size:
-                progress = (downloaded / total_size) * 100
-                log(f"Download progress: {progress:.1f}%")
-    
-    log(f"✅ Successfully downloaded to {local_filename}")
-    return local_filename
+    return response.json()["data"]
 
-def merge_and_loop(video_path: str, audio_path: str, output_path: str, loops: int = 5) -> str:
-    """Merge audio and video, then loop the result."""
-    log("🔄 Starting merge and loop process")
-    
-    # First merge audio and video
-    merged_path = os.path.join(os.path.dirname(output_path), "temp_merged.mp4")
-    
-    stream = ffmpeg.input(video_path)
-    audio = ffmpeg.input(audio_path)
-    stream = ffmpeg.output(stream, audio, merged_path,
-                         acodec='aac',
-                         vcodec='copy',
-                         shortest=None)
-    ffmpeg.run(stream, overwrite_output=True)
-    
-    # Create a temporary concat file
-    concat_file = os.path.join(os.path.dirname(output_path), "concat.txt")
-    with open(concat_file, "w") as f:
-        for _ in range(loops):
-            f.write(f"file '{os.path.abspath(merged_path)}'\n")
-    
-    # Use ffmpeg concat demuxer to loop the video
-    stream = ffmpeg.input(concat_file, format='concat', safe=0)
-    stream = ffmpeg.output(stream, output_path, c='copy')
-    ffmpeg.run(stream, overwrite_output=True)
-    
-    # Clean up temporary files
-    os.remove(concat_file)
-    os.remove(merged_path)
-    
-    log(f"✅ Merge and loop complete: {output_path}")
-    return output_path
-
-def upload_to_mux(video_path: str) -> dict:
-    """Upload video to Mux and create a playback ID."""
+async def upload_to_mux(content: AsyncIterator[bytes]) -> dict:
+    """Stream video bytes to Mux and create a playback ID."""
     log("📤 Starting Mux upload")
     
-    # Configure Mux API client
-    configuration = mux_python.Configuration()
-    configuration.username = os.getenv("MUX_TOKEN_ID")
-    configuration.password = os.getenv("MUX_TOKEN_SECRET")
-    
     # Create upload
-    uploads_api = mux_python.DirectUploadsApi(mux_python.ApiClient(configuration))
-    create_asset_request = mux_python.CreateAssetRequest(
-        playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
-        test=False,
-        metadata={
-            "video_type": "peaceful_content",
-            "app": "tiktok2"
-        }
-    )
-    create_upload_request = mux_python.CreateUploadRequest(
-        new_asset_settings=create_asset_request,
-        cors_origin="*"
-    )
-    
-    upload = uploads_api.create_direct_upload(create_upload_request)
+    upload = await mux_request("POST", "/video/v1/uploads", json={
+        "new_asset_settings": {
+            "playback_policy": ["public"],
+            "test": False,
+            "metadata": {
+                "video_type": "peaceful_content",
+                "app": "tiktok2"
+            }
+        },
+        "cors_origin": "*"
+    })
+    
+    # Register the waiter before the PUT so a fast webhook can't be missed
+    if MUX_WEBHOOK_SECRET:
+        asset_waiters[upload["id"]] = asyncio.get_running_loop().create_future()
     
-    # Upload file
-    with open(video_path, 'rb') as f:
-        response = requests.put(
-            upload.data.url,
-            data=f,
-            headers={'Content-Type': 'video/mp4'}
-        )
-        response.raise_for_status()
-    
-    # Wait for upload to complete
-    assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
+    try:
+        # Stream the video to Mux as it is produced; the length isn't known up
+        # front, so httpx sends it with chunked transfer encoding
+        async with httpx.AsyncClient(timeout=None) as client:
+            response = await client.put(
+                upload["url"],
+                content=content,
+                headers={'Content-Type': 'video/mp4'}
+            )
+            response.raise_for_status()
+        
+        if MUX_WEBHOOK_SECRET:
+            async with asyncio.timeout(MUX_WEBHOOK_TIMEOUT):
+                asset = await asset_waiters[upload["id"]]
+            return asset_response(asset)
+    finally:
+        asset_waiters.pop(upload["id"], None)
+    
+    # Wait for upload to complete, backing off from 0.5s up to 10s between polls
     max_retries = 30
+    delay = 0.5
     asset_id = None
     
     while max_retries > 0:
-        upload_status = uploads_api.get_direct_upload(upload.data.id)
-        if upload_status.data.asset_id:
-            asset_id = upload_status.data.asset_id
+        upload_status = await mux_request("GET", f"/video/v1/uploads/{upload['id']}")
+        if upload_status.get("asset_id"):
+            asset_id = upload_status["asset_id"]
             break
-        time.sleep(2)
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 10)
         max_retries -= 1
     
     if not asset_id:
@@ -218,27 +196,55 @@ def upload_to_mux(video_path: str) -> dict:
     # Wait for asset to be ready
     asset = None
     max_retries = 30
+    delay = 0.5
     
     while max_retries > 0:
-        asset = assets_api.get_asset(asset_id)
-        if asset.data.status == "ready":
+        asset = await mux_request("GET", f"/video/v1/assets/{asset_id}")
+        if asset["status"] == "ready":
             break
-        elif asset.data.status == "errored":
-            raise Exception(f"Asset creation failed: {asset.data.errors}")
-        time.sleep(5)
+        elif asset["status"] == "errored":
+            raise Exception(f"Asset creation failed: {asset.get('errors')}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 10)
         max_retries -= 1
     
-    if not asset or asset.data.status != "ready":
+    if not asset or asset["status"] != "ready":
         raise Exception("Asset failed to become ready in time")
     
-    playback_id = asset.data.playback_ids[0].id
+    return asset_response(asset)
+
+def asset_response(asset: dict) -> dict:
+    """Pick the IDs and playback URL out of a ready Mux asset."""
+    playback_id = asset["playback_ids"][0]["id"]
     
     return {
-        "asset_id": asset.data.id,
+        "asset_id": asset["id"],
         "playback_id": playback_id,
         "playback_url": f"https://stream.mux.com/{playback_id}.m3u8"
     }
 
+@app.post("/api/v1/mux-webhook")
+async def mux_webhook(request: Request):
+    """Resolve pending uploads when Mux reports their asset as ready or errored."""
+    if not MUX_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Mux webhooks are not enabled")
+    
+    body = await request.body()
+    if not verify_mux_signature(body, request.headers.get("Mux-Signature", "")):
+        raise HTTPException(status_code=401, detail="Invalid Mux signature")
+    
+    event = orjson.loads(body)
+    asset = event.get("data", {})
+    waiter = asset_waiters.get(asset.get("upload_id"))
+    if waiter and not waiter.done():
+        if event.get("type") == "video.asset.ready":
+            log(f"✅ Webhook: asset {asset.get('id')} is ready")
+            waiter.set_result(asset)
+        elif event.get("type") == "video.asset.errored":
+            waiter.set_exception(Exception(f"Asset creation failed: {asset.get('errors')}"))
+    
+    return {"received": True}
+
 @app.post("/api/v1/generate-peaceful-content", response_model=GenerationResponse)
 async def generate_peaceful_content(request: GenerationRequest):
     """Generate peaceful music and visuals based on user's vibe and heart rate."""
@@ -249,34 +255,20 @@ async def generate_peaceful_content(request: GenerationRequest):
     log(f"Intensity: {request.intensity}")
     
     try:
-        # Create output directory if it doesn't exist
-        os.makedirs("output", exist_ok=True)
-        
         # Adjust generation parameters based on heart rate intensity
         music_prompt = f"peaceful {request.vibe} music, "
         if request.intensity < 0.3:
             music_prompt += "very slow and calming, gentle ambient sounds, minimal rhythm"
-            fps = 24
-            num_frames = 72  # 3 seconds at 24fps
         elif request.intensity > 0.7:
             music_prompt += "upbeat and energetic while maintaining peace, clear rhythm"
-            fps = 30
-            num_frames = 120  # 4 seconds at 30fps
         else:
             music_prompt += "balanced and flowing, moderate tempo"
-            fps = 27
-            num_frames = 90  # ~3.3 seconds at 27fps
         
         # Prepare input parameters for music generation
         music_params = {
-            "model_version": "large",
+            **MUSICGEN_INPUT,
             "prompt": music_prompt,
-            "duration": 10,
             "temperature": 0.7 + (request.intensity * 0.3),  # Higher temperature for more variation at higher intensities
-            "top_k": 250,
-            "top_p": 0.99,
-            "classifier_free_guidance": 3,
-            "output_format": "mp3"
         }
         
         # Prepare input parameters for visualization
@@ -289,20 +281,12 @@ async def generate_peaceful_content(request: GenerationRequest):
             viz_prompt += "balanced flowing colors, smooth transitions, peaceful energy"
             
         viz_params = {
-            "prompt": viz_prompt,
-            "negative_prompt": "text, watermark, ugly, distorted, noisy, sharp, jarring",
-            "fps": fps,
-            "num_frames": num_frames,
-            "guidance_scale": 7.5,
-            "num_inference_steps": 50,
-            "width": 512,
-            "height": 512,
-            "scheduler": "DPM++ Karras SDE"
+            "prompt": viz_prompt
         }
         
         log("Generation parameters:")
-        log(f"Music: {json.dumps(music_params, indent=2)}")
-        log(f"Visualization: {json.dumps(viz_params, indent=2)}")
+        log(f"Music: {orjson.dumps(music_params, option=orjson.OPT_INDENT_2).decode()}")
+        log(f"Visualization: {orjson.dumps(viz_params, option=orjson.OPT_INDENT_2).decode()}")
         
         # Generate music and visualization in parallel
         music_url, viz_url = await asyncio.gather(
@@ -321,12 +305,9 @@ async def generate_peaceful_content(request: GenerationRequest):
                 download_file(viz_url, video_path)
             )
             
-            # Merge and loop
-            output_path = "output/merged_looped.mp4"
-            merged_path = merge_and_loop(video_path, audio_path, output_path)
-            
-            # Upload to Mux
-            mux_response = upload_to_mux(merged_path)
+            # Merge, loop and upload in one pipeline: FFmpeg's output is
+            # streamed straight into the Mux upload without touching disk
+            mux_response = await upload_to_mux(merge_and_loop(video_path, audio_path))
             
             total_time = time.time() - start_time
             log(f"✨ Process completed in {total_time:.2f} seconds")
@@ -354,10 +335,7 @@ async def generate_music_with_params(params: dict) -> str:
     """Generate music using the provided parameters."""
     log("🎵 Starting music generation with custom parameters")
     
-    output = replicate.run(
-        "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-        input=params
-    )
+    output = await run_prediction(MUSICGEN_MODEL, params)
     
     if isinstance(output, list) and len(output) > 0:
         output_url = str(output[0])
@@ -371,10 +349,7 @@ async def generate_visualization_with_params(params: dict) -> str:
     """Generate visualization using the provided parameters."""
     log("🎬 Starting visualization generation with custom parameters")
     
-    output = replicate.run(
-        "luma/ray",
-        input=params
-    )
+    output = await run_prediction(VIZ_MODEL, params)
     
     output_url = str(output)
     log(f"✅ Visualization generated: {output_url}")
@@ -395,26 +370,19 @@ async def read_root():
 async def get_peaceful_videos():
     """Get all peaceful content video playback IDs."""
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        
-        # Create assets API client
-        assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
-        
         # Get all assets with our metadata
-        assets = assets_api.list_assets()
+        assets = await mux_request("GET", "/video/v1/assets")
         
         # Filter for peaceful content videos and get their playback IDs
         peaceful_videos = []
-        for asset in assets.data:
-            if (asset.status == "ready" and 
-                asset.metadata and 
-                asset.metadata.get("video_type") == "peaceful_content" and
-                asset.metadata.get("app") == "tiktok2" and
-                asset.playback_ids):
-                peaceful_videos.append(asset.playback_ids[0].id)
+        for asset in assets:
+            metadata = asset.get("metadata")
+            if (asset.get("status") == "ready" and 
+                metadata and 
+                metadata.get("video_type") == "peaceful_content" and
+                metadata.get("app") == "tiktok2" and
+                asset.get("playback_ids")):
+                peaceful_videos.append(asset["playback_ids"][0]["id"])
         
         log(f"Found {len(peaceful_videos)} peaceful content videos")
         return peaceful_videos
@@ -429,25 +397,15 @@ async def get_peaceful_videos():
 async def update_asset_metadata(asset_id: str) -> bool:
     """Update an existing Mux asset with our metadata tags."""
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        
-        # Create assets API client
-        assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
-        
-        # Create proper update asset request using SDK model
         metadata = {
             "video_type": "peaceful_content",
             "app": "tiktok2"
         }
-        update_asset_request = mux_python.UpdateAssetRequest(metadata=metadata)
         
         # Update the asset
-        updated_asset = assets_api.update_asset(asset_id, update_asset_request)
+        updated_asset = await mux_request("PATCH", f"/video/v1/assets/{asset_id}", json={"metadata": metadata})
         log(f"✅ Updated metadata for asset {asset_id}")
-        log(f"Updated asset metadata: {updated_asset.data.metadata}")
+        log(f"Updated asset metadata: {updated_asset.get('metadata')}")
         return True
         
     except Exception as e:
@@ -1,61 +1,43 @@
 import os
-import json
 import time
+import asyncio
 import tempfile
-from datetime import datetime
 from typing import Optional
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import ffmpeg
-import requests
+from common import log, download_file, open_http_session, close_http_session
 
 # Create router
 router = APIRouter()
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
+# Each ffmpeg.probe spawns an ffprobe process; only run them when debugging
+DEBUG_PROBE = bool(os.getenv("DEBUG_PROBE"))
+
+# FFmpeg's own log level; "debug" writes a line per packet to stderr
+FFMPEG_LOGLEVEL = os.getenv("FFMPEG_LOGLEVEL", "error")
+
+# Open the shared download session when the router is mounted
+router.on_event("startup")(open_http_session)
+router.on_event("shutdown")(close_http_session)
 
 class MergeRequest(BaseModel):
     """Request model for merge endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     audio_url: str
     video_url: str
 
 class MergeResponse(BaseModel):
     """Response model for merge endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     output_path: Optional[str] = None
     status: str
     execution_time_seconds: float
     error: Optional[str] = None
 
-def download_file(url: str, local_filename: str) -> str:
-    """Download a file from a URL to a local file with progress logging."""
-    log(f"📥 Downloading from {url}")
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        
-        with open(local_filename, 'wb') as f:
-            if total_size == 0:
-                log("⚠️ Content length header missing, cannot track progress")
-            
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                downloaded += len(chunk)
-                if total_size:
-                    progress = (downloaded / total_size) * 100
-                    log(f"Download progress: {progress:.1f}%")
-        
-        log(f"✅ Successfully downloaded to {local_filename}")
-        return local_filename
-    except Exception as e:
-        log(f"❌ Download failed: {str(e)}")
-        raise
-
 def merge_audio_video(video_path: str, audio_path: str, output_path: str) -> str:
     """Merge audio and video using ffmpeg with detailed logging."""
     try:
@@ -64,26 +46,31 @@ def merge_audio_video(video_path: str, audio_path: str, output_path: str) -> str
         log(f"📦 Output path: {output_path}")
         
         # Get input file information
-        video_probe = ffmpeg.probe(video_path)
-        audio_probe = ffmpeg.probe(audio_path)
-        log(f"Video duration: {video_probe['format']['duration']}s")
-        log(f"Audio duration: {audio_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            video_probe = ffmpeg.probe(video_path)
+            audio_probe = ffmpeg.probe(audio_path)
+            log(f"Video duration: {video_probe['format']['duration']}s")
+            log(f"Audio duration: {audio_probe['format']['duration']}s")
         
-        # Merge audio and video
+        # Merge audio and video. Both tracks are stream-copied (Luma Ray returns
+        # H.264, MusicGen returns MP3, and MP3-in-MP4 is valid), so this is a
+        # container remux rather than an encode.
         stream = ffmpeg.input(video_path)
         audio = ffmpeg.input(audio_path)
         stream = ffmpeg.output(stream, audio, output_path,
-                             acodec='aac',
+                             acodec='copy',
                              vcodec='copy',
                              shortest=None,
-                             loglevel='debug')
+                             movflags='+faststart',
+                             loglevel=FFMPEG_LOGLEVEL)
         
         log("🔄 Executing FFmpeg merge command")
-        ffmpeg.run(stream, overwrite_output=True)
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
         
         # Verify output
-        output_probe = ffmpeg.probe(output_path)
-        log(f"Output file duration: {output_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            output_probe = ffmpeg.probe(output_path)
+            log(f"Output file duration: {output_probe['format']['duration']}s")
         log(f"Output file size: {os.path.getsize(output_path)} bytes")
         
         log("✅ Audio/video merge completed successfully")
@@ -96,36 +83,26 @@ def merge_audio_video(video_path: str, audio_path: str, output_path: str) -> str
         raise
 
 def loop_video(input_path: str, output_path: str, loops: int = 5) -> str:
-    """Loop a video file multiple times using ffmpeg concat."""
+    """Loop a video file multiple times using ffmpeg's -stream_loop."""
     try:
         log(f"🔁 Looping video {loops} times")
         log(f"Input video: {input_path}")
         log(f"Output path: {output_path}")
         
-        # Create a temporary concat file
-        concat_file = os.path.join(os.path.dirname(input_path), "concat.txt")
-        with open(concat_file, "w") as f:
-            for _ in range(loops):
-                f.write(f"file '{os.path.abspath(input_path)}'\n")
-        
-        log(f"Created concat file with {loops} entries")
-        
-        # Use ffmpeg concat demuxer to loop the video
-        stream = ffmpeg.input(concat_file, format='concat', safe=0)
+        # -stream_loop replays the input in-process; no concat list needed
+        stream = ffmpeg.input(input_path, stream_loop=loops - 1)
         stream = ffmpeg.output(stream, output_path,
                              c='copy',  # Copy both audio and video streams
-                             loglevel='debug')
+                             movflags='+faststart',
+                             loglevel=FFMPEG_LOGLEVEL)
         
         log("🔄 Executing FFmpeg loop command")
-        ffmpeg.run(stream, overwrite_output=True)
-        
-        # Clean up concat file
-        os.remove(concat_file)
-        log("🧹 Cleaned up temporary concat file")
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
         
         # Verify output
-        output_probe = ffmpeg.probe(output_path)
-        log(f"Final video duration: {output_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            output_probe = ffmpeg.probe(output_path)
+            log(f"Final video duration: {output_probe['format']['duration']}s")
         log(f"Final video size: {os.path.getsize(output_path)} bytes")
         
         log("✅ Video looping completed successfully")
@@ -153,12 +130,12 @@ async def merge_av(request: MergeRequest):
             merged_path = os.path.join(temp_dir, "merged.mp4")
             final_output = "output/merged_looped.mp4"
             
-            # Download files
-            log("⬇️ Downloading audio file")
-            download_file(request.audio_url, audio_path)
-            
-            log("⬇️ Downloading video file")
-            download_file(request.video_url, video_path)
+            # Download files concurrently
+            log("⬇️ Downloading audio and video files")
+            await asyncio.gather(
+                download_file(request.audio_url, audio_path),
+                download_file(request.video_url, video_path)
+            )
             
             # Merge files
             log("🔄 Merging audio and video")
@@ -1,22 +1,16 @@
-import os
-import json
 import time
-from datetime import datetime
 from typing import Optional
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-import replicate
+from pydantic import BaseModel, ConfigDict
+from common import REPLICATE_API_TOKEN, MUSICGEN_MODEL, MUSICGEN_INPUT, run_prediction, log, logger
 
 # Create router
 router = APIRouter()
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
-
 class MusicGenerationResponse(BaseModel):
     """Response model for music generation endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     job_id: Optional[str] = None
     output_url: Optional[str] = None
@@ -32,7 +26,7 @@ async def generate_music():
     
     try:
         # Check environment variables
-        if not os.getenv('REPLICATE_API_TOKEN'):
+        if not REPLICATE_API_TOKEN:
             raise HTTPException(
                 status_code=500,
                 detail="Missing REPLICATE_API_TOKEN environment variable"
@@ -42,23 +36,14 @@ async def generate_music():
         
         # Prepare input parameters
         input_params = {
-            "model_version": "large",
-            "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
-            "duration": 10,
-            "temperature": 0.7,
-            "top_k": 250,
-            "top_p": 0.99,
-            "classifier_free_guidance": 3,
-            "output_format": "mp3"
+            **MUSICGEN_INPUT,
+            "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings"
         }
-        log(f"Input parameters: {json.dumps(input_params, indent=2)}")
+        logger.debug("Input parameters: %s", input_params)
         
         # Generate music
         log("🎵 Starting music generation with Replicate")
-        output = replicate.run(
-            "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-            input=input_params
-        )
+        output = await run_prediction(MUSICGEN_MODEL, input_params)
         
         # Process output
         if isinstance(output, list) and len(output) > 0:
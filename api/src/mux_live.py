@@ -1,22 +1,18 @@
 import os
 import json
 import time
-from datetime import datetime
 from typing import Optional
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import mux_python
 
 # Create router
 router = APIRouter()
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
-
 class LiveStreamResponse(BaseModel):
     """Response model for live stream endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     status: str
     execution_time_seconds: float
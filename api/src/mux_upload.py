@@ -1,45 +1,88 @@
 import os
 import json
 import time
-from datetime import datetime
-from typing import Optional
-from fastapi import APIRouter, HTTPException, UploadFile, File
-from pydantic import BaseModel
+import uuid
+import mmap
+from typing import BinaryIO, Optional
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiofiles.tempfile
 import mux_python
 from mux_python.rest import ApiException
+from common import MUX_TOKEN_ID, MUX_TOKEN_SECRET, MUX_WEBHOOK_SECRET, verify_mux_signature, log
 
 # Create router
 router = APIRouter()
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
+# Size of each Content-Range PUT. The upload URL is a GCS resumable session,
+# which rejects non-final chunks that aren't a multiple of 256 KiB, so the
+# setting is rounded down to one (and never below 256 KiB)
+CHUNK_ALIGNMENT = 256 * 1024
+MUX_CHUNK_SIZE = max(CHUNK_ALIGNMENT, int(os.getenv("MUX_CHUNK_SIZE", str(32 * 1024 * 1024))) // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT)
+
+# One keep-alive session for all PUTs, so chunks after the first skip the handshake
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+))
+
+# Mux API clients, built once so every call shares one urllib3 pool
+MUX_CONFIGURATION = mux_python.Configuration()
+MUX_CONFIGURATION.username = MUX_TOKEN_ID
+MUX_CONFIGURATION.password = MUX_TOKEN_SECRET
+MUX_API = mux_python.ApiClient(MUX_CONFIGURATION)
+UPLOADS_API = mux_python.DirectUploadsApi(MUX_API)
+ASSETS_API = mux_python.AssetsApi(MUX_API)
+
+# Upload jobs by job ID, and the job ID for each Mux upload ID
+jobs: dict[str, dict] = {}
+upload_jobs: dict[str, str] = {}
 
 class MuxUploadResponse(BaseModel):
     """Response model for Mux upload endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     asset_id: Optional[str] = None
     playback_id: Optional[str] = None
     playback_url: Optional[str] = None
+    job_id: Optional[str] = None
     status: str
     execution_time_seconds: float
     error: Optional[str] = None
 
-def upload_to_mux(video_path: str) -> dict:
-    """Upload video to Mux using direct upload and create a playback ID with detailed logging."""
+class MuxJobResponse(BaseModel):
+    """Response model for the upload job status endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    job_id: str
+    upload_id: Optional[str] = None
+    status: str
+    asset_id: Optional[str] = None
+    playback_id: Optional[str] = None
+    playback_url: Optional[str] = None
+    error: Optional[str] = None
+
+def mark_ready(job: dict, asset_id: str, playback_id: str) -> None:
+    """Record a ready asset and its playback URL on the job."""
+    job.update(
+        status="ready",
+        asset_id=asset_id,
+        playback_id=playback_id,
+        playback_url=f"https://stream.mux.com/{playback_id}.m3u8"
+    )
+    log(f"✅ Job {job['job_id']} is ready: {job['playback_url']}")
+
+def upload_to_mux(f: BinaryIO, file_size: int) -> str:
+    """Upload an open video file to a new Mux direct upload and return the upload ID."""
     log("📤 Starting Mux upload")
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        log("Mux client configured")
-        
-        # Create API clients
-        uploads_api = mux_python.DirectUploadsApi(mux_python.ApiClient(configuration))
-        log("Mux Direct Uploads API client created")
-        
         # Create a direct upload URL with metadata
         create_upload_request = mux_python.CreateUploadRequest(
             new_asset_settings=mux_python.CreateAssetRequest(
@@ -56,127 +99,51 @@ def upload_to_mux(video_path: str) -> dict:
         )
         
         log("Creating direct upload with metadata")
-        upload = uploads_api.create_direct_upload(create_upload_request)
+        upload = UPLOADS_API.create_direct_upload(create_upload_request)
         log(f"✅ Upload created with ID: {upload.data.id}")
         
         # Upload the file
-        file_size = os.path.getsize(video_path)
-        chunk_size = 5 * 1024 * 1024  # 5MB chunks
+        chunk_size = MUX_CHUNK_SIZE
+        log(f"Uploading file to {upload.data.url}")
+        log(f"File size: {file_size} bytes")
         
-        with open(video_path, 'rb') as f:
-            log(f"Uploading file to {upload.data.url}")
-            log(f"File size: {file_size} bytes")
-            
-            import requests
-            
+        # Send zero-copy memoryview slices of an mmap of the file. requests
+        # sets Content-Length from their length, and http.client hands each
+        # one to the socket in a single sendall. The views are released
+        # before the mmap closes.
+        headers = {'Content-Type': 'video/mp4'}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
             # For small files, upload in one request
             if file_size <= chunk_size:
-                response = requests.put(
-                    upload.data.url,
-                    data=f,
-                    headers={
-                        'Content-Type': 'video/mp4',
-                        'Content-Length': str(file_size)
-                    }
-                )
+                response = SESSION.put(upload.data.url, data=view, headers=headers)
                 response.raise_for_status()
             else:
-                # For larger files, use chunked upload
+                # For larger files, use chunked upload. The upload URL is a
+                # resumable session, which only accepts ranges in order, so
+                # the chunks can't be sent in parallel.
                 offset = 0
+                last_logged = time.monotonic()
                 while offset < file_size:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                        
-                    end = min(offset + len(chunk), file_size)
-                    content_range = f'bytes {offset}-{end-1}/{file_size}'
+                    end = min(offset + chunk_size, file_size)
                     
-                    log(f"Uploading chunk: {content_range}")
-                    response = requests.put(
-                        upload.data.url,
-                        data=chunk,
-                        headers={
-                            'Content-Type': 'video/mp4',
-                            'Content-Length': str(len(chunk)),
-                            'Content-Range': content_range
-                        }
-                    )
+                    with view[offset:end] as chunk:
+                        response = SESSION.put(
+                            upload.data.url,
+                            data=chunk,
+                            headers={**headers, 'Content-Range': 'bytes %d-%d/%d' % (offset, end - 1, file_size)}
+                        )
                     
                     if response.status_code not in [200, 201, 308]:
                         raise Exception(f"Upload failed with status {response.status_code}: {response.text}")
                     
-                    offset += len(chunk)
-                    progress = (offset / file_size) * 100
-                    log(f"Upload progress: {progress:.1f}%")
+                    offset = end
+                    # Report progress at most every two seconds
+                    if time.monotonic() - last_logged >= 2:
+                        last_logged = time.monotonic()
+                        log(f"Upload progress: {(offset / file_size) * 100:.1f}%")
         
         log("✅ File uploaded successfully")
-        
-        # Wait for the upload to complete and get the asset ID
-        max_retries = 30
-        retry_count = 0
-        asset_id = None
-        
-        while retry_count < max_retries and not asset_id:
-            try:
-                log(f"Checking upload status (attempt {retry_count + 1}/{max_retries})")
-                upload_status = uploads_api.get_direct_upload(upload.data.id)
-                if upload_status.data.asset_id:
-                    asset_id = upload_status.data.asset_id
-                    log(f"✅ Upload complete, got asset ID: {asset_id}")
-                    break
-                else:
-                    log(f"Upload status: {upload_status.data.status}")
-                    time.sleep(2)
-                    retry_count += 1
-            except Exception as e:
-                log(f"Error checking upload status: {str(e)}")
-                time.sleep(2)
-                retry_count += 1
-        
-        if not asset_id:
-            raise Exception("Failed to get asset ID after upload")
-        
-        # Wait for the asset to be ready
-        assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
-        max_retries = 30
-        retry_count = 0
-        asset = None
-        
-        while retry_count < max_retries:
-            try:
-                log(f"Checking asset status (attempt {retry_count + 1}/{max_retries})")
-                asset = assets_api.get_asset(asset_id)
-                
-                if asset.data.status == "ready":
-                    log("✅ Asset is ready")
-                    break
-                elif asset.data.status == "errored":
-                    raise Exception(f"Asset creation failed: {asset.data.errors}")
-                else:
-                    log(f"Asset status: {asset.data.status}")
-                    time.sleep(5)
-                    retry_count += 1
-            except Exception as e:
-                log(f"Error checking asset status: {str(e)}")
-                time.sleep(5)
-                retry_count += 1
-        
-        if not asset or asset.data.status != "ready":
-            raise Exception("Asset failed to become ready in time")
-        
-        # Get the playback ID
-        playback_id = asset.data.playback_ids[0].id
-        log(f"Playback ID obtained: {playback_id}")
-        
-        response_data = {
-            "asset_id": asset.data.id,
-            "playback_id": playback_id,
-            "playback_url": f"https://stream.mux.com/{playback_id}.m3u8",
-            "status": asset.data.status
-        }
-        log(f"Full Mux response data: {json.dumps(response_data, indent=2)}")
-        
-        return response_data
+        return upload.data.id
     except ApiException as e:
         log(f"❌ Mux API error: {str(e)}")
         raise
@@ -184,16 +151,47 @@ def upload_to_mux(video_path: str) -> dict:
         log(f"❌ Unexpected error during Mux upload: {str(e)}")
         raise
 
-@router.post("/upload-to-mux", response_model=MuxUploadResponse)
-async def upload_video(file: UploadFile = File(...)):
-    """Upload a video file to Mux."""
+def run_upload_job(job_id: str, temp_path: str) -> None:
+    """Upload a saved video for a queued job, then leave it for the webhook or GET /jobs."""
+    job = jobs[job_id]
+    job["status"] = "uploading"
+    try:
+        with open(temp_path, 'rb') as f:
+            upload_id = upload_to_mux(f, os.fstat(f.fileno()).st_size)
+        
+        # Mux transcodes from here on; the webhook or GET /jobs picks up the result
+        upload_jobs[upload_id] = job_id
+        job.update(upload_id=upload_id, status="processing")
+        log(f"✨ Job {job_id} uploaded, Mux is processing")
+    except Exception as e:
+        job.update(status="failed", error=f"{type(e).__name__}: {str(e)}")
+        log(f"❌ Job {job_id} failed: {job['error']}")
+    finally:
+        os.unlink(temp_path)
+
+def refresh_job(job: dict) -> None:
+    """Check Mux once for a job that is still processing."""
+    upload = UPLOADS_API.get_direct_upload(job["upload_id"])
+    if not upload.data.asset_id:
+        return
+    
+    asset = ASSETS_API.get_asset(upload.data.asset_id)
+    if asset.data.status == "ready":
+        mark_ready(job, asset.data.id, asset.data.playback_ids[0].id)
+    elif asset.data.status == "errored":
+        job.update(status="errored", asset_id=asset.data.id, error=str(asset.data.errors))
+
+@router.post("/upload-to-mux", response_model=MuxUploadResponse, status_code=202)
+async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    """Queue a video file for upload to Mux and return a job to follow it."""
     start_time = time.time()
     log("🚀 Starting Mux upload")
     
     try:
         # Check environment variables
-        required_vars = ["MUX_TOKEN_ID", "MUX_TOKEN_SECRET"]
-        missing_vars = [var for var in required_vars if not os.getenv(var)]
+        missing_vars = [name for name, value in
+                        (("MUX_TOKEN_ID", MUX_TOKEN_ID), ("MUX_TOKEN_SECRET", MUX_TOKEN_SECRET))
+                        if not value]
         if missing_vars:
             raise HTTPException(
                 status_code=500,
@@ -201,35 +199,37 @@ async def upload_video(file: UploadFile = File(...)):
             )
         log("✅ All required environment variables are present")
         
-        # Save uploaded file temporarily
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_file:
-            temp_file.write(await file.read())
+        # The UploadFile is closed once this handler returns, so keep a copy
+        # on disk for the background upload, copying 1 MiB at a time
+        file_size = 0
+        async with aiofiles.tempfile.NamedTemporaryFile('wb', delete=False, suffix=".mp4") as temp_file:
+            while chunk := await file.read(1024 * 1024):
+                await temp_file.write(chunk)
+                file_size += len(chunk)
             temp_path = temp_file.name
-            log(f"Saved uploaded file to: {temp_path}")
         
-        try:
-            # Upload to Mux
-            mux_response = upload_to_mux(temp_path)
-            
-            # Calculate total processing time
-            total_time = time.time() - start_time
-            log(f"✨ Process completed successfully in {total_time:.2f} seconds")
-            
-            return MuxUploadResponse(
-                success=True,
-                asset_id=mux_response["asset_id"],
-                playback_id=mux_response["playback_id"],
-                playback_url=mux_response["playback_url"],
-                status="completed",
-                execution_time_seconds=round(total_time, 2)
-            )
-            
-        finally:
-            # Clean up temporary file
+        # An empty file can't be memory-mapped for the upload
+        if file_size == 0:
             os.unlink(temp_path)
-            log("🧹 Cleaned up temporary file")
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        
+        # Upload after the response is sent; BackgroundTasks runs it in the threadpool
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {"job_id": job_id, "status": "queued"}
+        background_tasks.add_task(run_upload_job, job_id, temp_path)
+        
+        total_time = time.time() - start_time
+        log(f"✨ Job {job_id} queued in {total_time:.2f} seconds")
+        
+        return MuxUploadResponse(
+            success=True,
+            job_id=job_id,
+            status="queued",
+            execution_time_seconds=round(total_time, 2)
+        )
             
+    except HTTPException:
+        raise
     except Exception as e:
         error_msg = f"{type(e).__name__}: {str(e)}"
         log(f"❌ Process failed: {error_msg}")
@@ -239,4 +239,37 @@ async def upload_video(file: UploadFile = File(...)):
             status="failed",
             error=error_msg,
             execution_time_seconds=round(time.time() - start_time, 2)
-        ) 
\ No newline at end of file
+        )
+
+@router.get("/jobs/{job_id}", response_model=MuxJobResponse)
+async def get_job(job_id: str):
+    """Return the status of an upload job, checking Mux once if no webhook has arrived."""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if job["status"] == "processing" and not MUX_WEBHOOK_SECRET:
+        await run_in_threadpool(refresh_job, job)
+    
+    return MuxJobResponse(**job)
+
+@router.post("/mux/webhook")
+async def mux_webhook(request: Request):
+    """Update upload jobs when Mux reports their asset as ready or errored."""
+    if not MUX_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Mux webhooks are not enabled")
+    
+    body = await request.body()
+    if not verify_mux_signature(body, request.headers.get("Mux-Signature", "")):
+        raise HTTPException(status_code=401, detail="Invalid Mux signature")
+    
+    event = json.loads(body)
+    asset = event.get("data", {})
+    job = jobs.get(upload_jobs.get(asset.get("upload_id"), ""))
+    if job:
+        if event.get("type") == "video.asset.ready":
+            mark_ready(job, asset["id"], asset["playback_ids"][0]["id"])
+        elif event.get("type") == "video.asset.errored":
+            job.update(status="errored", asset_id=asset.get("id"), error=str(asset.get("errors")))
+    
+    return {"received": True}
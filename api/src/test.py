@@ -1,15 +1,22 @@
 import os
 import json
 import time
+import asyncio
 import pytest
 from dotenv import load_dotenv
-import replicate
 from fastapi.testclient import TestClient
+from common import MUSICGEN_MODEL, MUSICGEN_INPUT, run_prediction
 from main import app
 
 # Load environment variables
 load_dotenv()
 
+# Request body shared by the direct Replicate call and the endpoint test
+INPUT_PARAMS = {
+    **MUSICGEN_INPUT,
+    "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings"
+}
+
 def log_response(data, title):
     """Pretty print API responses"""
     print(f"\n{'=' * 20} {title} {'=' * 20}")
@@ -27,16 +34,7 @@ def test_music_generation():
     # 1. Test direct Replicate API call
     print("\n1. Direct Replicate API Test")
     
-    input_params = {
-        "model_version": "large",
-        "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
-        "duration": 10,
-        "temperature": 0.7,
-        "top_k": 250,
-        "top_p": 0.99,
-        "classifier_free_guidance": 3,
-        "output_format": "mp3"
-    }
+    input_params = INPUT_PARAMS
     
     print("\nInput parameters:")
     log_response(input_params, "Input Parameters")
@@ -48,10 +46,7 @@ def test_music_generation():
     try:
         print("📡 Sending request to Replicate...")
         request_start = time.time()
-        output = replicate.run(
-            "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-            input=input_params
-        )
+        output = asyncio.run(run_prediction(MUSICGEN_MODEL, input_params))
         request_time = time.time() - request_start
         print(f"⏱️ Request completed in {request_time:.2f} seconds")
         
@@ -1,22 +1,16 @@
-import os
-import json
 import time
-from datetime import datetime
 from typing import Optional
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-import replicate
+from pydantic import BaseModel, ConfigDict
+from common import REPLICATE_API_TOKEN, VIZ_MODEL, run_prediction, log, logger
 
 # Create router
 router = APIRouter()
 
-def log(message: str) -> None:
-    """Simple logging with timestamp."""
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    print(f"[{timestamp}] {message}")
-
 class VizGenerationResponse(BaseModel):
     """Response model for visualization generation endpoint."""
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     success: bool
     job_id: Optional[str] = None
     output_url: Optional[str] = None
@@ -32,7 +26,7 @@ async def generate_visualization():
     
     try:
         # Check environment variables
-        if not os.getenv('REPLICATE_API_TOKEN'):
+        if not REPLICATE_API_TOKEN:
             raise HTTPException(
                 status_code=500,
                 detail="Missing REPLICATE_API_TOKEN environment variable"
@@ -42,24 +36,13 @@ async def generate_visualization():
         
         # Prepare input parameters
         input_params = {
-            "prompt": "beautiful abstract peaceful animation, soft flowing colors, gentle transitions, meditative visuals",
-            "negative_prompt": "text, watermark, ugly, distorted, noisy",
-            "fps": 30,
-            "num_frames": 90,  # 3 seconds at 30fps
-            "guidance_scale": 7.5,
-            "num_inference_steps": 50,
-            "width": 512,
-            "height": 512,
-            "scheduler": "DPM++ Karras SDE"
+            "prompt": "beautiful abstract peaceful animation, soft flowing colors, gentle transitions, meditative visuals"
         }
-        log(f"Input parameters: {json.dumps(input_params, indent=2)}")
+        logger.debug("Input parameters: %s", input_params)
         
         # Generate visualization
         log("🎬 Starting visualization generation with Replicate")
-        output = replicate.run(
-            "luma/ray",
-            input=input_params
-        )
+        output = await run_prediction(VIZ_MODEL, input_params)
         
         # Process output
         output_url = str(output)  # Luma Ray returns a single URL string
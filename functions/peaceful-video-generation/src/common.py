@@ -0,0 +1,44 @@
+import os
+import time
+import hmac
+import base64
+import hashlib
+
+# Load environment variables from .env for local runs; deployed functions get
+# theirs from the Appwrite runtime, so skip importing dotenv and reading the file
+if not os.getenv("APPWRITE_FUNCTION_ID"):
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# Signing secret for Replicate's completion callbacks ("whsec_..." from
+# Replicate's webhook settings)
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET", "")
+# Callbacks signed longer ago than this are rejected as replays
+REPLICATE_WEBHOOK_TOLERANCE = 300
+
+def verify_replicate_signature(headers, body):
+    """Check Replicate's webhook-signature header against the raw callback body."""
+    # Without the secret nothing can be verified, so every callback is refused
+    if not REPLICATE_WEBHOOK_SECRET:
+        return False
+    try:
+        timestamp = int(headers.get('webhook-timestamp', ''))
+    except ValueError:
+        return False
+    if abs(time.time() - timestamp) > REPLICATE_WEBHOOK_TOLERANCE:
+        return False
+    signed = f"{headers.get('webhook-id', '')}.{headers.get('webhook-timestamp', '')}.{body}"
+    key = base64.b64decode(REPLICATE_WEBHOOK_SECRET.split("_", 1)[-1])
+    expected = base64.b64encode(hmac.new(key, signed.encode(), hashlib.sha256).digest()).decode()
+    # The header holds space-separated "v1,<signature>" entries
+    signatures = [entry.split(",", 1)[-1] for entry in headers.get('webhook-signature', '').split()]
+    return any(hmac.compare_digest(expected, sig) for sig in signatures)
+
+def error_response(context, error, status=500, start_time=None, **extra):
+    """Build the JSON error body shared by every failure path."""
+    body = {"success": False, "error": str(error)}
+    if isinstance(error, Exception):
+        body["error_type"] = type(error).__name__
+    if start_time is not None:
+        body["execution_time_seconds"] = round(time.time() - start_time, 2)
+    return context.res.json({**body, **extra}, status)
@@ -2,12 +2,12 @@ import os
 import json
 import time
 import asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 import replicate
-import requests
+import httpx
 
 # Load environment variables
 load_dotenv()
@@ -23,20 +23,23 @@ databases = Databases(client)
 DATABASE_ID = "67a580230029e01e56af"
 COLLECTION_ID = "67acd38e002a566db74a"
 
+# Shared async HTTP client for URL checks
+HTTPX = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_keepalive_connections=10))
+
 def log(message):
     """Simple logging with timestamp."""
     timestamp = datetime.now().strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}")
 
-def check_url_accessibility(url):
+async def check_url_accessibility(url):
     """Check if a URL is accessible and return response details."""
     try:
-        response = requests.head(url, allow_redirects=True)
+        response = await HTTPX.head(url, follow_redirects=True)
         return {
             "status_code": response.status_code,
             "accessible": response.status_code == 200,
             "headers": dict(response.headers),
-            "url": response.url
+            "url": str(response.url)
         }
     except Exception as e:
         return {
@@ -66,39 +69,23 @@ async def generate_music():
         }
         log(f"📝 Input parameters prepared: {json.dumps(input_params, indent=2)}")
         
-        # Create job document
-        job = databases.create_document(
-            database_id=DATABASE_ID,
-            collection_id=COLLECTION_ID,
-            document_id='unique()',
-            data={
-                'status': 'processing',
-                'prompt': input_params['prompt'],
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
-            }
-        )
-        job_id = job['$id']
-        log(f"📄 Created job document with ID: {job_id}")
-        
-        # Generate music
+        # Generate music. The job document is written once, with its final
+        # status, after Replicate returns.
         log("🎵 Starting music generation...")
+        created_at = datetime.now(timezone.utc).isoformat()
         start_time = time.time()
-        output = replicate.run(
+        output = await replicate.async_run(
             "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
             input=input_params
         )
         generation_time = time.time() - start_time
         log(f"⏱️ Generation took {generation_time:.2f} seconds")
         
-        # Log output details
-        log(f"📦 Raw output type: {type(output)}")
-        log(f"📦 Raw output value: {output}")
+        # Log output details in one line
         if isinstance(output, list):
-            log(f"📦 Output is a list of length: {len(output)}")
-            for i, item in enumerate(output):
-                log(f"📦 Item {i} type: {type(item)}")
-                log(f"📦 Item {i} value: {item}")
+            log(f"📦 List output: n={len(output)} types={[type(item).__name__ for item in output]} values={output}")
+        else:
+            log(f"📦 Raw output ({type(output).__name__}): {output}")
         
         # Determine output URL
         if isinstance(output, list) and len(output) > 0:
@@ -109,23 +96,25 @@ async def generate_music():
         
         # Check URL accessibility
         log("🔍 Checking URL accessibility...")
-        url_check = check_url_accessibility(output_url)
+        url_check = await check_url_accessibility(output_url)
         log(f"🔍 URL check results: {json.dumps(url_check, indent=2)}")
         
-        # Update job document
-        update_data = {
-            'status': 'completed',
-            'output_url': output_url,
-            'execution_time_seconds': round(generation_time, 2),
-            'updated_at': datetime.now().isoformat()
-        }
-        databases.update_document(
+        # Create job document with the results
+        job = databases.create_document(
             database_id=DATABASE_ID,
             collection_id=COLLECTION_ID,
-            document_id=job_id,
-            data=update_data
+            document_id='unique()',
+            data={
+                'status': 'completed',
+                'prompt': input_params['prompt'],
+                'output_url': output_url,
+                'execution_time_seconds': round(generation_time, 2),
+                'created_at': created_at,
+                'updated_at': datetime.now(timezone.utc).isoformat()
+            }
         )
-        log(f"✅ Updated job document with results")
+        job_id = job['$id']
+        log(f"📄 Created job document with ID: {job_id}")
         
         return {
             "success": True,
@@ -138,21 +127,24 @@ async def generate_music():
     except Exception as e:
         error_msg = f"{type(e).__name__}: {str(e)}"
         log(f"❌ Error: {error_msg}")
-        if 'job_id' in locals():
+        if 'input_params' in locals() and 'job_id' not in locals():
             try:
-                databases.update_document(
+                now = datetime.now(timezone.utc).isoformat()
+                databases.create_document(
                     database_id=DATABASE_ID,
                     collection_id=COLLECTION_ID,
-                    document_id=job_id,
+                    document_id='unique()',
                     data={
                         'status': 'failed',
+                        'prompt': input_params['prompt'],
                         'error': error_msg,
-                        'updated_at': datetime.now().isoformat()
+                        'created_at': created_at if 'created_at' in locals() else now,
+                        'updated_at': now
                     }
                 )
-                log("📝 Updated job document with error status")
-            except Exception as update_error:
-                log(f"❌ Failed to update job with error: {str(update_error)}")
+                log("📝 Created job document with error status")
+            except Exception as create_error:
+                log(f"❌ Failed to record failed job: {str(create_error)}")
         raise
 
 async def main():
@@ -163,6 +155,8 @@ async def main():
         log(f"✨ Test completed successfully: {json.dumps(result, indent=2)}")
     except Exception as e:
         log(f"💥 Test failed: {str(e)}")
+    finally:
+        await HTTPX.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
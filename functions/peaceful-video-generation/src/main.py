@@ -1,17 +1,108 @@
 import os
 import json
 import time
+import hashlib
+import asyncio
 import ffmpeg
 import replicate
-import requests
 import tempfile
 from pathlib import Path
-from dotenv import load_dotenv
-import mux_python
-from mux_python.rest import ApiException
+from urllib.parse import urlparse, parse_qs
+import aiohttp
+from common import REPLICATE_WEBHOOK_SECRET, verify_replicate_signature, error_response
 
-# Load environment variables
-load_dotenv()
+# Verbose request/response dumps are only built when LOG_LEVEL=DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Headers left out of debug dumps
+SENSITIVE_HEADERS = {"authorization", "cookie", "x-appwrite-key", "x-appwrite-user-jwt"}
+
+# Replicate client, built once per container so warm invocations reuse its connections
+REPLICATE = replicate.Client(api_token=os.getenv("REPLICATE_API_KEY"))
+
+# Public URL of this function. When set, main starts both predictions and returns
+# right away, and Replicate's completion webhook calls back in to finish the job
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL", "")
+# How long finalize waits for the music prediction once the video is done
+MUSIC_WAIT_TIMEOUT = int(os.getenv("MUSIC_WAIT_TIMEOUT", "300"))
+
+# Replicate outputs keyed by a hash of model and input, kept for warm invocations.
+# Off by default, since a cache hit republishes the same media as a new asset;
+# output URLs on replicate.delivery expire after an hour, so keep
+# REPLICATE_CACHE_TTL below that when turning it on
+REPLICATE_CACHE_TTL = int(os.getenv("REPLICATE_CACHE_TTL", "0"))
+replicate_cache = {}
+
+async def cached_run(model, input, context):
+    """Run a Replicate model, sharing a recent or in-flight run for identical inputs."""
+    if REPLICATE_CACHE_TTL <= 0:
+        return await REPLICATE.async_run(model, input=input)
+    
+    key = hashlib.sha256((model + json.dumps(input, sort_keys=True)).encode()).hexdigest()
+    cached = replicate_cache.get(key)
+    if cached and time.time() - cached[0] < REPLICATE_CACHE_TTL:
+        context.log(f"♻️ Reusing cached output for {model}")
+        task = cached[1]
+    else:
+        # Store the task rather than its result, so concurrent identical
+        # requests wait on the one prediction
+        task = asyncio.ensure_future(REPLICATE.async_run(model, input=input))
+        replicate_cache[key] = (time.time(), task)
+    
+    try:
+        # Shielded so one caller giving up doesn't cancel the run for the others
+        return await asyncio.shield(task)
+    except Exception:
+        if replicate_cache.get(key, (None, None))[1] is task:
+            del replicate_cache[key]
+        raise
+
+# Mux credentials and the HTTP session for its API, kept across warm invocations
+MUX_AUTH = aiohttp.BasicAuth(os.getenv("MUX_TOKEN_ID", ""), os.getenv("MUX_TOKEN_SECRET", ""))
+http_session = None
+
+def get_http_session():
+    """Return the shared aiohttp session, opening it on first use."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+        )
+    return http_session
+
+# Scratch files go to RAM-backed /dev/shm when the container has it
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Each ffmpeg.probe spawns an ffprobe process; only run them when debugging
+DEBUG_PROBE = bool(os.getenv("DEBUG_PROBE"))
+
+# FFmpeg's own log level; "debug" writes a line per packet to stderr
+FFMPEG_LOGLEVEL = os.getenv("FFMPEG_LOGLEVEL", "error")
+
+# When true, Mux ingests the video and music URLs as separate tracks and the
+# local FFmpeg merge is skipped
+MUX_SERVER_SIDE_MUX = os.getenv("MUX_SERVER_SIDE_MUX", "").lower() == "true"
+
+class BufferedLog:
+    """Wrap the Appwrite context so log lines are sent to the runtime in one batch."""
+    def __init__(self, context):
+        self.context = context
+        self.lines = []
+    
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+    
+    def log(self, message):
+        self.lines.append(str(message))
+    
+    def error(self, message):
+        # Errors go out straight away, after whatever was logged before them
+        self.flush()
+        self.context.error(message)
+    
+    def flush(self):
+        if self.lines:
+            self.context.log("\n".join(self.lines))
+            self.lines = []
 
 def check_env_vars(context):
     """Check and log the status of required environment variables."""
@@ -24,53 +115,29 @@ def check_env_vars(context):
     
     context.log("✅ All required environment variables are present")
 
-def download_file(url, local_filename, context):
-    """Download a file from a URL to a local file with progress logging."""
-    context.log(f"📥 Starting download from {url}")
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        
-        with open(local_filename, 'wb') as f:
-            if total_size == 0:
-                context.log("⚠️ Content length header missing, cannot track progress")
-            
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                downloaded += len(chunk)
-                if total_size:
-                    progress = (downloaded / total_size) * 100
-                    context.log(f"Download progress: {progress:.1f}%")
-        
-        context.log(f"✅ Successfully downloaded to {local_filename}")
-        return local_filename
-    except Exception as e:
-        context.error(f"❌ Download failed: {str(e)}")
-        raise
+MUSIC_MODEL = "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906"
+MUSIC_INPUT = {
+    "model_version": "large",
+    "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
+    "duration": 10,
+    "temperature": 0.7,
+    "top_k": 250,
+    "top_p": 0.99,
+    "classifier_free_guidance": 3,
+    "output_format": "mp3"
+}
+VIDEO_MODEL = "arielreplicate/stable_diffusion_infinite_zoom"
+VIDEO_INPUT = {
+    "prompt": "abstract peaceful patterns, soft flowing colors, gentle transitions, meditative visuals",
+    "duration": 10
+}
 
-def generate_music(context):
+async def generate_music(context):
     """Generate peaceful music using Meta's MusicGen model."""
     context.log("🎵 Starting music generation")
     try:
-        client = replicate.Client(api_token=os.getenv("REPLICATE_API_KEY"))
-        context.log("Replicate client initialized")
-        
         context.log("Sending request to MusicGen model")
-        output = client.run(
-            "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-            input={
-                "model_version": "large",
-                "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
-                "duration": 10,
-                "temperature": 0.7,
-                "top_k": 250,
-                "top_p": 0.99,
-                "classifier_free_guidance": 3,
-                "output_format": "mp3"
-            }
-        )
+        output = await cached_run(MUSIC_MODEL, MUSIC_INPUT, context)
         
         context.log(f"✅ Music generated successfully: {output}")
         return output
@@ -78,21 +145,12 @@ def generate_music(context):
         context.error(f"❌ Music generation failed: {str(e)}")
         raise
 
-def generate_video(context):
+async def generate_video(context):
     """Generate peaceful video using Replicate's stable_diffusion_infinite_zoom model."""
     context.log("🎬 Starting video generation")
     try:
-        client = replicate.Client(api_token=os.getenv("REPLICATE_API_KEY"))
-        context.log("Replicate client initialized")
-        
         context.log("Sending request to video generation model")
-        output = client.run(
-            "arielreplicate/stable_diffusion_infinite_zoom",
-            input={
-                "prompt": "abstract peaceful patterns, soft flowing colors, gentle transitions, meditative visuals",
-                "duration": 10
-            }
-        )
+        output = await cached_run(VIDEO_MODEL, VIDEO_INPUT, context)
         
         context.log(f"✅ Video generated successfully: {output}")
         return output
@@ -100,35 +158,49 @@ def generate_video(context):
         context.error(f"❌ Video generation failed: {str(e)}")
         raise
 
-def merge_audio_video(video_path, audio_path, output_path, context):
-    """Merge audio and video using ffmpeg with detailed logging."""
+async def create_prediction(model, input, webhook=None):
+    """Start a Replicate prediction without waiting for it, optionally with a completion webhook."""
+    options = {"webhook": webhook, "webhook_events_filter": ["completed"]} if webhook else {}
+    if ":" in model:
+        return await REPLICATE.predictions.async_create(version=model.split(":", 1)[1], input=input, **options)
+    return await REPLICATE.models.predictions.async_create(model=model, input=input, **options)
+
+# Audio that is already AAC can be stream-copied into the MP4; anything else
+# (MusicGen returns MP3) is encoded to AAC
+AAC_EXTENSIONS = (".aac", ".m4a", ".mp4")
+
+def audio_codec_args(audio_source):
+    """Pick FFmpeg audio options for an input, copying AAC instead of re-encoding it."""
+    if urlparse(str(audio_source)).path.lower().endswith(AAC_EXTENSIONS):
+        return {"acodec": "copy"}
+    return {"acodec": "aac", "audio_bitrate": "128k"}
+
+def merge_audio_video(video_url, audio_url, output_path, context):
+    """Merge audio and video straight from their URLs using ffmpeg with detailed logging."""
     context.log("🔄 Starting audio/video merge")
     try:
-        context.log(f"Input video: {video_path}")
-        context.log(f"Input audio: {audio_path}")
+        context.log(f"Input video: {video_url}")
+        context.log(f"Input audio: {audio_url}")
         context.log(f"Output path: {output_path}")
         
-        # Get input file information
-        video_probe = ffmpeg.probe(video_path)
-        audio_probe = ffmpeg.probe(audio_path)
-        context.log(f"Video duration: {video_probe['format']['duration']}s")
-        context.log(f"Audio duration: {audio_probe['format']['duration']}s")
-        
-        # Merge audio and video
-        stream = ffmpeg.input(video_path)
-        audio = ffmpeg.input(audio_path)
+        # Merge audio and video. FFmpeg reads both inputs over HTTPS while it
+        # muxes, so they never touch the disk; reconnect covers dropped streams.
+        stream = ffmpeg.input(video_url, reconnect=1, reconnect_streamed=1, reconnect_delay_max=5)
+        audio = ffmpeg.input(audio_url, reconnect=1, reconnect_streamed=1, reconnect_delay_max=5)
         stream = ffmpeg.output(stream, audio, output_path,
-                             acodec='aac',
                              vcodec='copy',
+                             **audio_codec_args(audio_url),
                              shortest=None,
-                             loglevel='debug')
+                             movflags='+faststart',
+                             loglevel=FFMPEG_LOGLEVEL)
         
         context.log("Executing FFmpeg merge command")
-        ffmpeg.run(stream, overwrite_output=True)
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
         
         # Verify output
-        output_probe = ffmpeg.probe(output_path)
-        context.log(f"Output file duration: {output_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            output_probe = ffmpeg.probe(output_path)
+            context.log(f"Output file duration: {output_probe['format']['duration']}s")
         context.log(f"Output file size: {Path(output_path).stat().st_size} bytes")
         
         context.log("✅ Audio/video merge completed successfully")
@@ -140,60 +212,202 @@ def merge_audio_video(video_path, audio_path, output_path, context):
         context.error(f"❌ Unexpected error during merge: {str(e)}")
         raise
 
-def upload_to_mux(video_path, context):
-    """Upload video to Mux and create a playback ID with detailed logging."""
+async def upload_to_mux(session, video_path, context, audio_url=None, passthrough=None):
+    """Upload video (plus an optional separate audio track) to Mux and create a playback ID with detailed logging."""
     context.log("📤 Starting Mux upload")
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        context.log("Mux client configured")
-        
-        # Create API client
-        assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
-        context.log("Mux Assets API client created")
-        
         # Prepare upload request
-        input_settings = [mux_python.InputSettings(url=video_path)]
-        create_asset_request = mux_python.CreateAssetRequest(
-            input=input_settings,
-            playback_policy=[mux_python.PlaybackPolicy.PUBLIC]
-        )
+        inputs = [{"url": video_path}]
+        if audio_url:
+            inputs.append({
+                "url": audio_url,
+                "type": "audio",
+                "language_code": "en",
+                "name": "Music"
+            })
         context.log(f"Preparing to upload file: {video_path}")
         
-        # Create the asset
+        # Create the asset through the REST API
         context.log("Creating Mux asset")
-        asset = assets_api.create_asset(create_asset_request)
-        context.log(f"✅ Asset created successfully: {asset.data.id}")
+        async with session.post(
+            "https://api.mux.com/video/v1/assets",
+            json={"input": inputs, "playback_policy": ["public"],
+                  **({"passthrough": passthrough} if passthrough else {})},
+            auth=MUX_AUTH
+        ) as response:
+            if response.status >= 400:
+                raise Exception(f"Mux API error {response.status}: {await response.text()}")
+            asset = (await response.json())["data"]
+        context.log(f"✅ Asset created successfully: {asset['id']}")
         
         # Get the playback ID
-        playback_id = asset.data.playback_ids[0].id
+        playback_id = asset["playback_ids"][0]["id"]
         context.log(f"Playback ID obtained: {playback_id}")
         
         response_data = {
-            "asset_id": asset.data.id,
+            "asset_id": asset["id"],
             "playback_id": playback_id,
             "playback_url": f"https://stream.mux.com/{playback_id}.m3u8"
         }
-        context.log(f"Full Mux response data: {json.dumps(response_data, indent=2)}")
+        if LOG_LEVEL == "DEBUG":
+            context.log(f"Full Mux response data: {json.dumps(response_data)}")
         
         return response_data
-    except ApiException as e:
-        context.error(f"❌ Mux API error: {str(e)}")
-        raise
     except Exception as e:
         context.error(f"❌ Unexpected error during Mux upload: {str(e)}")
         raise
 
-def main(context):
-    """Main function to handle the request with comprehensive logging."""
+async def find_published_asset(session, prediction_id):
+    """Return the Mux asset already published for a prediction, if it is among the latest assets."""
+    async with session.get(
+        "https://api.mux.com/video/v1/assets", params={"limit": "100"}, auth=MUX_AUTH
+    ) as response:
+        if response.status >= 400:
+            raise Exception(f"Mux API error {response.status}: {await response.text()}")
+        assets = (await response.json())["data"]
+    return next((asset for asset in assets if asset.get("passthrough") == prediction_id), None)
+
+# Video prediction IDs this container has finalized or is finalizing, so
+# concurrent callback redeliveries don't publish twice
+finalized_predictions = set()
+
+class PredictionFailed(Exception):
+    """A prediction ended without output, so redelivering its callback can't help."""
+
+async def publish(video_url, audio_url, context, passthrough=None):
+    """Merge the generated music and video (or hand both to Mux) and upload the result."""
+    session = get_http_session()
+    if MUX_SERVER_SIDE_MUX:
+        # Let Mux fetch both URLs and combine the tracks on ingest
+        context.log("Step 3: Sending video and audio URLs to Mux")
+        return await upload_to_mux(session, str(video_url), context, audio_url=str(audio_url),
+                                   passthrough=passthrough)
+    
+    # Process files
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as temp_dir:
+        context.log(f"Created temporary directory: {temp_dir}")
+        
+        merged_path = os.path.join(temp_dir, "merged.mp4")
+        
+        # Merge files straight from the generated URLs; FFmpeg
+        # blocks, so it runs on a worker thread
+        context.log("Step 3: Merging audio and video")
+        merged_file = await asyncio.to_thread(
+            merge_audio_video, str(video_url), str(audio_url), merged_path, context
+        )
+        
+        # Upload to Mux
+        context.log("Step 4: Uploading to Mux")
+        return await upload_to_mux(session, merged_file, context, passthrough=passthrough)
+
+async def kickoff(context):
+    """Start both predictions and return; Replicate calls back into finalize when the video is done."""
+    try:
+        check_env_vars(context)
+        if not REPLICATE_WEBHOOK_SECRET:
+            # Unsigned callbacks are refused, so the job could never finish
+            raise EnvironmentError("REPLICATE_WEBHOOK_URL is set without REPLICATE_WEBHOOK_SECRET")
+        
+        # Music finishes well before the video, so only the video prediction gets
+        # the webhook and carries the music prediction's ID along in its URL
+        music = await create_prediction(MUSIC_MODEL, MUSIC_INPUT)
+        video = await create_prediction(VIDEO_MODEL, VIDEO_INPUT, webhook=f"{REPLICATE_WEBHOOK_URL}?music={music.id}")
+        context.log(f"🚀 Started music prediction {music.id} and video prediction {video.id}")
+        
+        return context.res.json({
+            "success": True,
+            "music_prediction_id": music.id,
+            "video_prediction_id": video.id,
+            "message": "Generation started"
+        }, 202)
+    except Exception as e:
+        context.error(f"❌ Kickoff failed: {str(e)}")
+        return error_response(context, e)
+
+async def finalize(context):
+    """Handle Replicate's completion webhook for the video prediction and publish the result."""
+    start_time = time.time()
+    if not verify_replicate_signature(context.req.headers, context.req.bodyText):
+        return error_response(context, "Invalid signature", 401)
+    
+    # Both IDs come from the signed body: the video prediction's own ID, and
+    # the music prediction's ID from the webhook URL kickoff gave it
+    callback = json.loads(context.req.bodyText)
+    video_id = callback["id"]
+    music_id = parse_qs(urlparse(callback.get("webhook") or "").query).get("music", [None])[0]
+    if not music_id:
+        return error_response(context, "Missing music prediction ID", 400)
+    
+    if video_id in finalized_predictions:
+        context.log(f"♻️ Prediction {video_id} already finalized, ignoring redelivery")
+        return context.res.json({"success": True})
+    finalized_predictions.add(video_id)
+    
+    try:
+        # A redelivery may land on another container; Mux assets carry the
+        # video prediction ID as passthrough, so look there too
+        published = await find_published_asset(get_http_session(), video_id)
+        if published:
+            context.log(f"♻️ Prediction {video_id} already published as asset {published['id']}")
+            return context.res.json({"success": True})
+        
+        # Both predictions are re-read from Replicate rather than trusting the
+        # posted body
+        video = await REPLICATE.predictions.async_get(video_id)
+        music = await REPLICATE.predictions.async_get(music_id)
+        if video.status != "succeeded":
+            raise PredictionFailed(f"Video prediction {video.id} {video.status}: {video.error}")
+        
+        # The music prediction is nearly always done by now; if not, wait it
+        # out, up to MUSIC_WAIT_TIMEOUT
+        try:
+            async with asyncio.timeout(MUSIC_WAIT_TIMEOUT):
+                while music.status not in ("succeeded", "failed", "canceled"):
+                    await asyncio.sleep(2)
+                    music = await REPLICATE.predictions.async_get(music.id)
+        except TimeoutError:
+            raise Exception(f"Music prediction {music.id} still {music.status} after {MUSIC_WAIT_TIMEOUT}s")
+        if music.status != "succeeded":
+            raise PredictionFailed(f"Music prediction {music.id} {music.status}: {music.error}")
+        
+        mux_response = await publish(video.output, music.output, context, passthrough=video.id)
+        context.log(f"✨ Finalized predictions in {time.time() - start_time:.2f} seconds")
+        return context.res.json({"success": True, "mux_data": mux_response})
+    except PredictionFailed as e:
+        context.error(f"❌ Finalize failed: {str(e)}")
+        # Answer Replicate's callback with a 200 anyway; a failed prediction
+        # stays failed on a redelivery
+        return error_response(context, e, 200, start_time=start_time)
+    except Exception as e:
+        context.error(f"❌ Finalize failed: {str(e)}")
+        # Anything else (Replicate, Mux or FFmpeg trouble, or music still
+        # running) may pass on a retry, so let Replicate redeliver the callback
+        finalized_predictions.discard(video_id)
+        return error_response(context, e, 502, start_time=start_time)
+
+async def main(context):
+    """Entry point; buffers the invocation's log lines and flushes them once at the end."""
+    buffered = BufferedLog(context)
+    try:
+        return await handle(buffered)
+    finally:
+        buffered.flush()
+
+async def handle(context):
+    """Handle the request with comprehensive logging."""
     # Immediate entry point verification
     context.log("🎯 Function entry point reached")
     context.log(f"Request method: {context.req.method}")
-    context.log(f"Request headers: {json.dumps(dict(context.req.headers), indent=2)}")
+    if LOG_LEVEL == "DEBUG":
+        context.log(f"Request headers: {json.dumps({k: v for k, v in context.req.headers.items() if k.lower() not in SENSITIVE_HEADERS})}")
     context.log(f"Request body: {context.req.bodyText if hasattr(context.req, 'bodyText') else 'No body'}")
     
+    # Replicate completion callbacks carry the music prediction ID in the query
+    if context.req.query.get("music"):
+        return await finalize(context)
+    if REPLICATE_WEBHOOK_URL:
+        return await kickoff(context)
+    
     context.log("🚀 Starting peaceful video generation process")
     start_time = time.time()
     
@@ -201,33 +415,15 @@ def main(context):
         # Check environment variables
         check_env_vars(context)
         
-        # Generate content
-        context.log("Step 1: Generating audio content")
-        audio_url = generate_music(context)
-        context.log("Step 2: Generating video content")
-        video_url = generate_video(context)
+        # Generate content. The two predictions are independent, so run them
+        # side by side and wait for both.
+        context.log("Steps 1-2: Generating audio and video content in parallel")
+        audio_url, video_url = await asyncio.gather(
+            generate_music(context),
+            generate_video(context)
+        )
         
-        # Process files
-        with tempfile.TemporaryDirectory() as temp_dir:
-            context.log(f"Created temporary directory: {temp_dir}")
-            
-            # Define paths
-            audio_path = os.path.join(temp_dir, "audio.mp3")
-            video_path = os.path.join(temp_dir, "video.mp4")
-            merged_path = os.path.join(temp_dir, "merged.mp4")
-            
-            # Download files
-            context.log("Step 3: Downloading generated files")
-            download_file(audio_url, audio_path, context)
-            download_file(video_url, video_path, context)
-            
-            # Merge files
-            context.log("Step 4: Merging audio and video")
-            merged_file = merge_audio_video(video_path, audio_path, merged_path, context)
-            
-            # Upload to Mux
-            context.log("Step 5: Uploading to Mux")
-            mux_response = upload_to_mux(merged_file, context)
+        mux_response = await publish(video_url, audio_url, context)
         
         # Calculate total processing time
         total_time = time.time() - start_time
@@ -242,8 +438,5 @@ def main(context):
             
     except Exception as e:
         context.error(f"❌ Process failed: {str(e)}")
-        return context.res.json({
-            "success": False,
-            "error": str(e),
-            "processing_time": f"{time.time() - start_time:.2f} seconds"
-        }) 
\ No newline at end of file
+        return error_response(context, e, start_time=start_time,
+                              processing_time=f"{time.time() - start_time:.2f} seconds") 
\ No newline at end of file
@@ -2,13 +2,16 @@ import os
 import json
 import time
 import asyncio
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 import ffmpeg
-import requests
+import httpx
 from appwrite.query import Query
 
 # Load environment variables
@@ -26,32 +29,47 @@ DATABASE_ID = "67a580230029e01e56af"
 MUSIC_COLLECTION_ID = "67acd38e002a566db74a"  # music_generation_jobs
 VIDEO_COLLECTION_ID = "67acf64500037ab9c429"  # viz-generation-jobs
 
+# Scratch files go to RAM-backed /dev/shm when the container has it
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Each ffmpeg.probe spawns an ffprobe process; only run them when debugging
+DEBUG_PROBE = bool(os.getenv("DEBUG_PROBE"))
+
+# FFmpeg's own log level; "debug" writes a line per packet to stderr
+FFMPEG_LOGLEVEL = os.getenv("FFMPEG_LOGLEVEL", "error")
+
+# Pooled HTTP/2 client for downloads, reused across files and invocations;
+# same-host downloads share one multiplexed connection
+SESSION = httpx.Client(
+    # httpx ignores the client's pool options when a transport is given, so they go here
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=8)
+    ),
+    timeout=60.0,
+    # Asset URLs may redirect to their storage host, as requests followed them
+    follow_redirects=True
+)
+
 def log(message):
     """Simple logging with timestamp."""
     timestamp = datetime.now().strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}")
 
 def download_file(url, local_filename):
-    """Download a file from a URL to a local file with progress logging."""
+    """Download a file from a URL to a local file."""
     log(f"📥 Downloading from {url}")
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
+        with SESSION.stream('GET', url) as response:
+            response.raise_for_status()
+            # Write in 1 MiB blocks; iter_bytes decodes any gzip/deflate
+            # transfer encoding
+            with open(local_filename, 'wb') as f:
+                for chunk in response.iter_bytes(1024 * 1024):
+                    f.write(chunk)
         
-        with open(local_filename, 'wb') as f:
-            if total_size == 0:
-                log("⚠️ Content length header missing, cannot track progress")
-            
-            downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                downloaded += len(chunk)
-                if total_size:
-                    progress = (downloaded / total_size) * 100
-                    log(f"Download progress: {progress:.1f}%")
-        
-        log(f"✅ Successfully downloaded to {local_filename}")
+        log(f"✅ Successfully downloaded {os.path.getsize(local_filename)} bytes to {local_filename}")
         return local_filename
     except Exception as e:
         log(f"❌ Download failed: {str(e)}")
@@ -60,24 +78,34 @@ def download_file(url, local_filename):
 def get_latest_successful_job(collection_id):
     """Get the most recent successfully completed job from a collection."""
     try:
-        # First get all completed jobs
+        # Newest completed job, fetching only the fields we read
         response = databases.list_documents(
             database_id=DATABASE_ID,
             collection_id=collection_id,
             queries=[
                 Query.equal('status', 'completed'),
                 Query.order_desc('$createdAt'),
-                Query.limit(1)
+                Query.limit(1),
+                Query.select(['$id', 'status', 'output_url'])
             ]
         )
         
-        if response['total'] > 0:
-            return response['documents'][0]
-        return None
+        docs = response.get('documents') or []
+        return docs[0] if docs else None
     except Exception as e:
         log(f"❌ Failed to get latest job: {str(e)}")
         raise
 
+# Audio that is already AAC can be stream-copied into the MP4; anything else
+# (MusicGen returns MP3) is encoded to AAC
+AAC_EXTENSIONS = (".aac", ".m4a", ".mp4")
+
+def audio_codec_args(audio_source):
+    """Pick FFmpeg audio options for an input, copying AAC instead of re-encoding it."""
+    if audio_source.lower().endswith(AAC_EXTENSIONS):
+        return {"acodec": "copy"}
+    return {"acodec": "aac", "audio_bitrate": "128k"}
+
 def merge_audio_video(video_path, audio_path, output_path):
     """Merge audio and video using ffmpeg with detailed logging."""
     try:
@@ -86,26 +114,29 @@ def merge_audio_video(video_path, audio_path, output_path):
         log(f"📦 Output path: {output_path}")
         
         # Get input file information
-        video_probe = ffmpeg.probe(video_path)
-        audio_probe = ffmpeg.probe(audio_path)
-        log(f"Video duration: {video_probe['format']['duration']}s")
-        log(f"Audio duration: {audio_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            video_probe = ffmpeg.probe(video_path)
+            audio_probe = ffmpeg.probe(audio_path)
+            log(f"Video duration: {video_probe['format']['duration']}s")
+            log(f"Audio duration: {audio_probe['format']['duration']}s")
         
         # Merge audio and video
         stream = ffmpeg.input(video_path)
         audio = ffmpeg.input(audio_path)
         stream = ffmpeg.output(stream, audio, output_path,
-                             acodec='aac',
                              vcodec='copy',
+                             **audio_codec_args(audio_path),
                              shortest=None,
-                             loglevel='debug')
+                             movflags='+faststart',
+                             loglevel=FFMPEG_LOGLEVEL)
         
         log("🔄 Executing FFmpeg merge command")
-        ffmpeg.run(stream, overwrite_output=True)
+        ffmpeg.run(stream, overwrite_output=True, quiet=True)
         
         # Verify output
-        output_probe = ffmpeg.probe(output_path)
-        log(f"Output file duration: {output_probe['format']['duration']}s")
+        if DEBUG_PROBE:
+            output_probe = ffmpeg.probe(output_path)
+            log(f"Output file duration: {output_probe['format']['duration']}s")
         log(f"Output file size: {os.path.getsize(output_path)} bytes")
         
         log("✅ Audio/video merge completed successfully")
@@ -136,19 +167,20 @@ async def main():
         log(f"Found video: {video_job['output_url']}")
         
         # Create temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as temp_dir:
             log(f"📁 Created temporary directory: {temp_dir}")
             
             # Download files
-            audio_path = os.path.join(temp_dir, "audio.mp3")
+            # Keep the source's extension so audio_codec_args sees the real format
+            audio_ext = os.path.splitext(urlparse(music_job['output_url']).path)[1] or ".mp3"
+            audio_path = os.path.join(temp_dir, f"audio{audio_ext}")
             video_path = os.path.join(temp_dir, "video.mp4")
             output_path = os.path.join(temp_dir, "merged.mp4")
             
-            log("⬇️ Downloading audio file")
-            download_file(music_job['output_url'], audio_path)
-            
-            log("⬇️ Downloading video file")
-            download_file(video_job['output_url'], video_path)
+            log("⬇️ Downloading audio and video files in parallel")
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(lambda args: download_file(*args),
+                                  [(music_job['output_url'], audio_path), (video_job['output_url'], video_path)]))
             
             # Merge files
             log("🔄 Merging audio and video")
@@ -157,7 +189,6 @@ async def main():
             # Copy to a permanent location
             final_output = "output/merged.mp4"
             os.makedirs("output", exist_ok=True)
-            import shutil
             shutil.copy2(merged_path, final_output)
             log(f"✨ Final output saved to: {os.path.abspath(final_output)}")
             
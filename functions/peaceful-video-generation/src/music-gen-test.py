@@ -1,50 +1,109 @@
 import os
-import json
+import orjson
 import time
 import asyncio
-from datetime import datetime
-from dotenv import load_dotenv
+from datetime import datetime, timezone
 from appwrite.client import Client
 from appwrite.services.databases import Databases
-import replicate
+import httpx
+from common import error_response
 
-# Load environment variables
-load_dotenv()
+# Initialize Appwrite once per container from the function environment
+client = Client()
+client.set_endpoint('https://cloud.appwrite.io/v1')
+client.set_project(os.getenv('APPWRITE_FUNCTION_PROJECT_ID', ''))
+client.set_key(os.getenv('APPWRITE_FUNCTION_API_KEY', ''))
+databases = Databases(client)
 
-# Initialize Appwrite (using function context)
-client = None
-databases = None
-
-def init_appwrite(context):
-    """Initialize Appwrite client with function context."""
-    global client, databases
-    client = Client()
-    
-    # Log available environment info
-    context.log("Available environment variables:")
-    context.log(str(dir(context)))
-    
-    # Initialize with function environment
-    client.set_endpoint('https://cloud.appwrite.io/v1')
-    client.set_project(os.getenv('APPWRITE_FUNCTION_PROJECT_ID', ''))
-    client.set_key(os.getenv('APPWRITE_FUNCTION_API_KEY', ''))
-    databases = Databases(client)
+# Request header dumps are only built when LOG_LEVEL=DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Headers left out of debug dumps
+SENSITIVE_HEADERS = {"authorization", "cookie", "x-appwrite-key", "x-appwrite-user-jwt"}
 
 # Constants
 DATABASE_ID = "67a580230029e01e56af"
 COLLECTION_ID = "67acd38e002a566db74a"
 
+# Caps on in-flight Replicate predictions and Appwrite writes, so bursts of jobs
+# queue here instead of running into either service's rate limits
+REPLICATE_SEM = asyncio.Semaphore(int(os.getenv("REPLICATE_MAX_INFLIGHT", "3")))
+APPWRITE_SEM = asyncio.Semaphore(2)
+
+# Replicate's HTTP API, called directly so predictions can use sync mode
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
+MUSICGEN_VERSION = "7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906"
+REPLICATE_HTTP = httpx.AsyncClient(
+    base_url="https://api.replicate.com/v1",
+    headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}"},
+    timeout=httpx.Timeout(70.0)
+)
+
 def safe_json_dumps(obj):
     """Safely convert object to JSON string."""
-    return json.dumps(obj, indent=2, default=str)
+    return orjson.dumps(obj, default=str).decode()
+
+# Input parameters are the same for every request, so build them and their
+# logged form once
+MUSIC_INPUT = {
+    "model_version": "large",
+    "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
+    "duration": 10,
+    "temperature": 0.7,
+    "top_k": 250,
+    "top_p": 0.99,
+    "classifier_free_guidance": 3,
+    "output_format": "mp3"
+}
+MUSIC_INPUT_JSON = safe_json_dumps(MUSIC_INPUT)
+
+async def replicate_request(method, path, **kwargs):
+    """Call Replicate's API, retrying once after a transient failure."""
+    # A POST that timed out or got a 5xx from the gateway may already have
+    # started a (billed) prediction, so it is only retried when the
+    # connection failed and nothing was sent
+    if method == "POST":
+        try:
+            return await REPLICATE_HTTP.request(method, path, **kwargs)
+        except httpx.ConnectError:
+            await asyncio.sleep(0.25)
+            return await REPLICATE_HTTP.request(method, path, **kwargs)
+    
+    try:
+        response = await REPLICATE_HTTP.request(method, path, **kwargs)
+        if response.status_code < 500:
+            return response
+    except (httpx.ConnectError, httpx.ReadTimeout):
+        pass
+    await asyncio.sleep(0.25)
+    return await REPLICATE_HTTP.request(method, path, **kwargs)
 
 async def generate_music(context, input_params):
     """Async function to generate music using Replicate."""
     try:
-        return replicate.run(
-            "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-            input=input_params
-        )
+        async with REPLICATE_SEM:
+            # Sync mode holds the request open until the prediction finishes
+            # (up to 60 s), so the output comes back without a trailing poll
+            response = await replicate_request(
+                "POST",
+                "/predictions",
+                json={"version": MUSICGEN_VERSION, "input": input_params},
+                headers={"Prefer": "wait=60"}
+            )
+            response.raise_for_status()
+            prediction = response.json()
+            
+            # Longer runs fall back to polling with capped backoff
+            attempt = 0
+            while prediction["status"] not in ("succeeded", "failed", "canceled"):
+                await asyncio.sleep(min(5.0, 0.2 * (2 ** attempt)))
+                attempt += 1
+                response = await replicate_request("GET", f"/predictions/{prediction['id']}")
+                response.raise_for_status()
+                prediction = response.json()
+        
+        if prediction["status"] != "succeeded":
+            raise Exception(f"Prediction {prediction['id']} {prediction['status']}: {prediction.get('error')}")
+        return prediction["output"]
     except Exception as e:
         context.error(f"Music generation error: {str(e)}")
         raise
@@ -52,6 +111,7 @@ async def generate_music(context, input_params):
 def create_job_document(prompt):
     """Create a new job document in Appwrite."""
     try:
+        now = datetime.now(timezone.utc).isoformat()
         return databases.create_document(
             database_id=DATABASE_ID,
             collection_id=COLLECTION_ID,
@@ -59,8 +119,8 @@ def create_job_document(prompt):
             data={
                 'status': 'processing',
                 'prompt': prompt,
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
+                'created_at': now,
+                'updated_at': now
             }
         )
     except Exception as e:
@@ -69,7 +129,7 @@ def create_job_document(prompt):
 def update_job_document(job_id, data):
     """Update an existing job document in Appwrite."""
     try:
-        data['updated_at'] = datetime.now().isoformat()
+        data['updated_at'] = datetime.now(timezone.utc).isoformat()
         return databases.update_document(
             database_id=DATABASE_ID,
             collection_id=COLLECTION_ID,
@@ -86,13 +146,9 @@ async def process_music_generation(context, job_id, input_params, start_time):
         context.log("🎵 Starting music generation")
         output = await generate_music(context, input_params)
         
-        # Log output details for debugging
-        context.log(f"Raw output type: {type(output)}")
-        context.log(f"Raw output value: {output}")
-        if isinstance(output, list):
-            context.log(f"Output is a list of length: {len(output)}")
-            context.log(f"First element type: {type(output[0])}")
-            context.log(f"First element value: {output[0]}")
+        # Log output details for debugging, as a single line
+        if LOG_LEVEL == "DEBUG":
+            context.log(f"Raw output ({type(output).__name__}): {output}")
         
         # Calculate execution time
         execution_time = time.time() - start_time
@@ -108,23 +164,25 @@ async def process_music_generation(context, job_id, input_params, start_time):
         
         context.log(f"Final output URL: {output_url}")
         
-        # Update job with success
-        update_job_document(job_id, {
-            'status': 'completed',
-            'output_url': output_url,
-            'execution_time_seconds': round(execution_time, 2)
-        })
+        # Update job with success; the Appwrite SDK blocks, so on a worker thread
+        async with APPWRITE_SEM:
+            await asyncio.to_thread(update_job_document, job_id, {
+                'status': 'completed',
+                'output_url': output_url,
+                'execution_time_seconds': round(execution_time, 2)
+            })
         
         context.log(f"✅ Job completed successfully in {execution_time:.2f} seconds")
         
     except Exception as e:
         # Update job with error
         error_msg = f"{type(e).__name__}: {str(e)}"
-        update_job_document(job_id, {
-            'status': 'failed',
-            'error': error_msg,
-            'execution_time_seconds': round(time.time() - start_time, 2)
-        })
+        async with APPWRITE_SEM:
+            await asyncio.to_thread(update_job_document, job_id, {
+                'status': 'failed',
+                'error': error_msg,
+                'execution_time_seconds': round(time.time() - start_time, 2)
+            })
         context.error(f"❌ Job failed: {error_msg}")
 
 async def main(context):
@@ -132,50 +190,33 @@ async def main(context):
     start_time = time.time()
     context.log("🎯 Test function entry point reached")
     
-    # Initialize Appwrite
-    init_appwrite(context)
-    context.log("✅ Initialized Appwrite client")
-    
-    # Log request details
-    context.log(f"Request method: {context.req.method}")
-    context.log(f"Request path: {context.req.path}")
-    context.log(f"Request headers: {safe_json_dumps(dict(context.req.headers))}")
-    
     # Handle non-API requests
     if context.req.path and context.req.path != "/":
-        return context.res.json({
-            "success": False,
-            "error": "Invalid endpoint. Please use the root path '/' for music generation.",
-            "path": context.req.path
-        }, 404)
+        return error_response(context, "Invalid endpoint. Please use the root path '/' for music generation.",
+                              404, start_time=start_time, path=context.req.path)
     
     # Check environment variables
-    if not os.getenv('REPLICATE_API_TOKEN'):
+    if not REPLICATE_API_TOKEN:
         error_msg = "Missing REPLICATE_API_TOKEN environment variable"
         context.error(f"❌ {error_msg}")
-        return context.res.json({
-            "success": False,
-            "error": error_msg
-        }, 500)
+        return error_response(context, error_msg, start_time=start_time)
     
     context.log("✅ Found Replicate API token")
     
+    # Log request details once the request is known to be served
+    context.log(f"Request method: {context.req.method}")
+    context.log(f"Request path: {context.req.path}")
+    if LOG_LEVEL == "DEBUG":
+        context.log(f"Request headers: {safe_json_dumps({k: v for k, v in context.req.headers.items() if k.lower() not in SENSITIVE_HEADERS})}")
+    
     try:
-        # Prepare input parameters
-        input_params = {
-            "model_version": "large",
-            "prompt": "peaceful ambient meditation music, calming lofi beats, gentle and soothing, no lyrics, soft piano and strings",
-            "duration": 10,
-            "temperature": 0.7,
-            "top_k": 250,
-            "top_p": 0.99,
-            "classifier_free_guidance": 3,
-            "output_format": "mp3"
-        }
-        context.log(f"Input parameters: {safe_json_dumps(input_params)}")
+        input_params = MUSIC_INPUT
+        context.log(f"Input parameters: {MUSIC_INPUT_JSON}")
         
-        # Create job document
-        job = create_job_document(input_params['prompt'])
+        # Create job document; the Appwrite SDK blocks, so it runs on a worker
+        # thread and in-flight jobs keep making progress
+        async with APPWRITE_SEM:
+            job = await asyncio.to_thread(create_job_document, input_params['prompt'])
         job_id = job['$id']
         context.log(f"✅ Created job document with ID: {job_id}")
         
@@ -191,7 +232,4 @@ async def main(context):
             
     except Exception as e:
         context.error(f"❌ Setup error: {str(e)}")
-        return context.res.json({
-            "success": False,
-            "error": str(e)
-        }, 500) 
\ No newline at end of file
+        return error_response(context, e, start_time=start_time) 
\ No newline at end of file
@@ -1,88 +1,87 @@
 import os
 import json
 import time
+import asyncio
+from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-import mux_python
-from mux_python.rest import ApiException
+import httpx
 
 # Load environment variables
 load_dotenv()
 
+# Async client for the Mux API; the semaphore keeps concurrent calls under Mux's rate limits
+MUX_CLIENT = httpx.AsyncClient(
+    base_url="https://api.mux.com/video/v1",
+    auth=(os.getenv("MUX_TOKEN_ID", ""), os.getenv("MUX_TOKEN_SECRET", "")),
+    http2=True,
+    limits=httpx.Limits(max_connections=32),
+    timeout=30.0
+)
+MUX_SEM = asyncio.Semaphore(8)
+
+async def mux_request(method, path, **kwargs):
+    """Call the Mux API and return the response's data object."""
+    async with MUX_SEM:
+        response = await MUX_CLIENT.request(method, path, **kwargs)
+    response.raise_for_status()
+    return response.json()["data"]
+
 def log(message):
     """Simple logging with timestamp."""
-    from datetime import datetime
     timestamp = datetime.now().strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}")
 
-def create_simulated_live_stream(asset_id, duration_seconds=60):
+async def create_simulated_live_stream(asset_id, duration_seconds=60):
     """Create a simulated live stream using an existing asset."""
     log("🎬 Starting simulated live stream setup")
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        log("Mux client configured")
-        
-        # Create API clients
-        live_api = mux_python.LiveStreamsApi(mux_python.ApiClient(configuration))
-        log("Mux Live Streams API client created")
-        
         # Create a new live stream
-        create_stream_request = mux_python.CreateLiveStreamRequest(
-            playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
-            new_asset_settings=mux_python.CreateAssetRequest(
-                playback_policy=[mux_python.PlaybackPolicy.PUBLIC]
-            ),
-            test=False
-        )
-        
         log("Creating live stream")
-        live_stream = live_api.create_live_stream(create_stream_request)
-        log(f"✅ Live stream created with ID: {live_stream.data.id}")
+        live_stream = await mux_request("POST", "/live-streams", json={
+            "playback_policy": ["public"],
+            "new_asset_settings": {
+                "playback_policy": ["public"]
+            },
+            "test": False
+        })
+        log(f"✅ Live stream created with ID: {live_stream['id']}")
         
         # Create a playback ID for the live stream
-        playback_id = live_stream.data.playback_ids[0].id
+        playback_id = live_stream["playback_ids"][0]["id"]
         log(f"Live stream playback ID: {playback_id}")
         
         # Create simulated live stream using the asset
         log(f"Setting up simulation with asset ID: {asset_id}")
         
-        # Create a simulcast target for the live stream
-        simulcast_request = mux_python.CreateSimulcastTargetRequest(
-            passthrough="simulated_live",
-            stream_key=live_stream.data.stream_key,
-            url=f"rtmp://global-live.mux.com/{live_stream.data.stream_key}"
-        )
-        
-        # Start the simulation by creating a simulcast target
+        # Start the simulation by creating a simulcast target for the live stream
         log("Starting simulation")
-        simulcast = live_api.create_live_stream_simulcast_target(
-            live_stream.data.id,
-            simulcast_request
-        )
+        simulcast = await mux_request("POST", f"/live-streams/{live_stream['id']}/simulcast-targets", json={
+            "passthrough": "simulated_live",
+            "stream_key": live_stream["stream_key"],
+            "url": f"rtmp://global-live.mux.com/{live_stream['stream_key']}"
+        })
         
         response_data = {
-            "live_stream_id": live_stream.data.id,
+            "live_stream_id": live_stream["id"],
             "playback_id": playback_id,
             "playback_url": f"https://stream.mux.com/{playback_id}.m3u8",
-            "status": live_stream.data.status,
-            "stream_key": live_stream.data.stream_key,
-            "simulcast_id": simulcast.data.id
+            "status": live_stream["status"],
+            "stream_key": live_stream["stream_key"],
+            "simulcast_id": simulcast["id"]
         }
         
         log(f"Full live stream response data: {json.dumps(response_data, indent=2)}")
         return response_data
         
-    except ApiException as e:
-        log(f"❌ Mux API error: {str(e)}")
+    except httpx.HTTPStatusError as e:
+        log(f"❌ Mux API error: {e.response.status_code} {e.response.text}")
         raise
     except Exception as e:
         log(f"❌ Unexpected error during live stream setup: {str(e)}")
         raise
 
-def main():
+async def main():
     """Main function to test simulated live stream setup."""
     log("🚀 Starting simulated live stream test")
     start_time = time.time()
@@ -99,7 +98,7 @@ def main():
         asset_id = "JilZH8uTSaFNba39ggo4Il200s00wNKIkjM9njm7501EC00"  # Replace with your asset ID
         
         # Create simulated live stream
-        live_response = create_simulated_live_stream(asset_id)
+        live_response = await create_simulated_live_stream(asset_id)
         
         # Calculate total processing time
         total_time = time.time() - start_time
@@ -114,6 +113,8 @@ def main():
     except Exception as e:
         log(f"❌ Process failed: {str(e)}")
         raise
+    finally:
+        await MUX_CLIENT.aclose()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    asyncio.run(main()) 
\ No newline at end of file
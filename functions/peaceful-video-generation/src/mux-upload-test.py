@@ -1,177 +1,187 @@
 import os
 import json
 import time
+import uuid
+import asyncio
+from datetime import datetime
+import random
 from pathlib import Path
 from dotenv import load_dotenv
-import mux_python
-from mux_python.rest import ApiException
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 
 # Load environment variables
 load_dotenv()
 
+# When a Mux webhook endpoint is configured for the environment, video.asset.ready
+# is pushed to it and the upload returns without polling for the asset
+MUX_WEBHOOK_SECRET = os.getenv("MUX_WEBHOOK_SECRET", "")
+
+# Pooled session for upload PUTs. The upload body is a one-shot stream, so only
+# connection failures and GETs are retried, never a PUT that was already sent
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      allowed_methods=frozenset({"GET"}))
+))
+
+# Async client for the Mux API; the semaphore keeps concurrent calls under Mux's rate limits
+MUX_CLIENT = httpx.AsyncClient(
+    base_url="https://api.mux.com/video/v1",
+    auth=(os.getenv("MUX_TOKEN_ID", ""), os.getenv("MUX_TOKEN_SECRET", "")),
+    http2=True,
+    limits=httpx.Limits(max_connections=32),
+    timeout=30.0
+)
+MUX_SEM = asyncio.Semaphore(8)
+
+async def mux_request(method, path, **kwargs):
+    """Call the Mux API and return the response's data object."""
+    async with MUX_SEM:
+        response = await MUX_CLIENT.request(method, path, **kwargs)
+    response.raise_for_status()
+    return response.json()["data"]
+
+# Overall time allowed for the upload and asset to finish processing
+MUX_POLL_DEADLINE = 600
+
+def poll_delay(attempt):
+    """Capped exponential backoff with jitter between status checks."""
+    return min(8.0, 0.25 * (2 ** attempt)) + random.uniform(0, 0.25)
+
 def log(message):
     """Simple logging with timestamp."""
-    from datetime import datetime
     timestamp = datetime.now().strftime("%H:%M:%S")
     print(f"[{timestamp}] {message}")
 
-def upload_to_mux(video_path):
+class ProgressReader:
+    """File wrapper that logs upload progress as the HTTP client reads from it."""
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.sent = 0
+        self.last_logged = time.monotonic()
+    
+    def __len__(self):
+        return self.size
+    
+    def read(self, n=-1):
+        chunk = self.f.read(n)
+        self.sent += len(chunk)
+        # Report progress at most every two seconds
+        if time.monotonic() - self.last_logged >= 2:
+            self.last_logged = time.monotonic()
+            log(f"Upload progress: {(self.sent / self.size) * 100:.1f}%")
+        return chunk
+
+async def upload_to_mux(video_path):
     """Upload video to Mux using direct upload and create a playback ID with detailed logging."""
     log("📤 Starting Mux upload")
     try:
-        # Configure Mux API client
-        configuration = mux_python.Configuration()
-        configuration.username = os.getenv("MUX_TOKEN_ID")
-        configuration.password = os.getenv("MUX_TOKEN_SECRET")
-        log("Mux client configured")
-        
-        # Create API clients
-        uploads_api = mux_python.DirectUploadsApi(mux_python.ApiClient(configuration))
-        log("Mux Direct Uploads API client created")
-        
-        # Create a direct upload URL with video quality settings
-        create_upload_request = mux_python.CreateUploadRequest(
-            new_asset_settings=mux_python.CreateAssetRequest(
-                playback_policy=[mux_python.PlaybackPolicy.PUBLIC],
-                test=False,
-                encoding_tier="baseline"
-            ),
-            cors_origin="*",
-            timeout=3600  # 1 hour timeout
-        )
-        
+        # Create a direct upload URL with video quality settings; the passthrough
+        # ID comes back on the asset's webhook events
+        job_id = uuid.uuid4().hex
         log("Creating direct upload")
-        upload = uploads_api.create_direct_upload(create_upload_request)
-        log(f"✅ Upload created with ID: {upload.data.id}")
-        log(f"Asset ID: {upload.data.asset_id}")  # Log the asset ID for debugging
-        
-        # Upload the file using the direct upload URL
-        import requests
+        upload = await mux_request("POST", "/uploads", json={
+            "new_asset_settings": {
+                "playback_policy": ["public"],
+                "test": False,
+                "encoding_tier": "baseline",
+                "passthrough": job_id
+            },
+            "cors_origin": "*",
+            "timeout": 3600  # 1 hour timeout
+        })
+        log(f"✅ Upload created with ID: {upload['id']}")
+        log(f"Asset ID: {upload.get('asset_id')}")  # Log the asset ID for debugging
+        
+        # Upload the file using the direct upload URL, as one streaming PUT;
+        # requests blocks, so it runs on a worker thread
         file_size = os.path.getsize(video_path)
-        chunk_size = 5 * 1024 * 1024  # 5MB chunks
         
         with open(video_path, 'rb') as f:
-            log(f"Uploading file to {upload.data.url}")
+            log(f"Uploading file to {upload['url']}")
             log(f"File size: {file_size} bytes")
             
-            # For small files, upload in one request
-            if file_size <= chunk_size:
-                response = requests.put(
-                    upload.data.url,
-                    data=f,
-                    headers={
-                        'Content-Type': 'video/mp4',
-                        'Content-Length': str(file_size)
-                    }
-                )
-                response.raise_for_status()
-            else:
-                # For larger files, use chunked upload
-                offset = 0
-                while offset < file_size:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                        
-                    end = min(offset + len(chunk), file_size)
-                    content_range = f'bytes {offset}-{end-1}/{file_size}'
-                    
-                    log(f"Uploading chunk: {content_range}")
-                    response = requests.put(
-                        upload.data.url,
-                        data=chunk,
-                        headers={
-                            'Content-Type': 'video/mp4',
-                            'Content-Length': str(len(chunk)),
-                            'Content-Range': content_range
-                        }
-                    )
-                    
-                    if response.status_code not in [200, 201, 308]:
-                        raise Exception(f"Upload failed with status {response.status_code}: {response.text}")
-                    
-                    offset += len(chunk)
-                    progress = (offset / file_size) * 100
-                    log(f"Upload progress: {progress:.1f}%")
+            response = await asyncio.to_thread(
+                SESSION.put,
+                upload['url'],
+                data=ProgressReader(f, file_size),
+                headers={'Content-Type': 'video/mp4'}
+            )
+            if response.status_code not in [200, 201]:
+                raise Exception(f"Upload failed with status {response.status_code}: {response.text}")
         
         log("✅ File uploaded successfully")
         
+        if MUX_WEBHOOK_SECRET:
+            log("Asset readiness will arrive via the Mux webhook")
+            return {
+                "upload_id": upload['id'],
+                "passthrough": job_id,
+                "status": "processing"
+            }
+        
         # Wait for the upload to complete and get the asset ID
-        max_retries = 30
-        retry_count = 0
+        deadline = time.monotonic() + MUX_POLL_DEADLINE
+        attempt = 0
         asset_id = None
+        last_status = None
         
-        while retry_count < max_retries and not asset_id:
+        log("Waiting for upload to be processed")
+        while not asset_id and time.monotonic() < deadline:
             try:
-                log(f"Checking upload status (attempt {retry_count + 1}/{max_retries})")
-                upload_status = uploads_api.get_direct_upload(upload.data.id)
-                if upload_status.data.asset_id:
-                    asset_id = upload_status.data.asset_id
+                upload_status = await mux_request("GET", f"/uploads/{upload['id']}")
+                if upload_status.get("asset_id"):
+                    asset_id = upload_status["asset_id"]
                     log(f"✅ Upload complete, got asset ID: {asset_id}")
                     break
-                else:
-                    log(f"Upload status: {upload_status.data.status}")
-                    time.sleep(2)
-                    retry_count += 1
+                # Only log when the status actually changes
+                if upload_status['status'] != last_status:
+                    last_status = upload_status['status']
+                    log(f"Upload status: {last_status}")
             except Exception as e:
                 log(f"Error checking upload status: {str(e)}")
-                time.sleep(2)
-                retry_count += 1
+            await asyncio.sleep(poll_delay(attempt))
+            attempt += 1
         
         if not asset_id:
             raise Exception("Failed to get asset ID after upload")
         
-        # Wait for the asset to be ready
-        assets_api = mux_python.AssetsApi(mux_python.ApiClient(configuration))
-        max_retries = 30  # Increase retries since video processing can take time
-        retry_count = 0
-        asset = None
-        
-        log(f"Checking status for asset ID: {asset_id}")
-        
-        while retry_count < max_retries:
-            try:
-                log(f"Checking asset status (attempt {retry_count + 1}/{max_retries})")
-                asset = assets_api.get_asset(asset_id)
-                
-                if asset.data.status == "ready":
-                    log("✅ Asset is ready")
-                    break
-                elif asset.data.status == "errored":
-                    raise Exception(f"Asset creation failed: {asset.data.errors}")
-                else:
-                    log(f"Asset status: {asset.data.status}")
-                    time.sleep(5)  # Increase sleep time to give more time for processing
-                    retry_count += 1
-            except Exception as e:
-                log(f"Error checking asset status: {str(e)}")
-                time.sleep(5)
-                retry_count += 1
-        
-        if not asset or asset.data.status != "ready":
-            raise Exception("Asset failed to become ready in time")
+        # The playback ID exists as soon as the asset does, so read it once
+        # instead of waiting for processing to finish; the stream URL starts
+        # working when the asset reaches "ready"
+        log(f"Fetching asset {asset_id}")
+        asset = await mux_request("GET", f"/assets/{asset_id}")
+        if asset["status"] == "errored":
+            raise Exception(f"Asset creation failed: {asset.get('errors')}")
+        log(f"Asset status: {asset['status']}")
         
         # Get the playback ID
-        playback_id = asset.data.playback_ids[0].id
+        playback_id = asset["playback_ids"][0]["id"]
         log(f"Playback ID obtained: {playback_id}")
         
         response_data = {
-            "asset_id": asset.data.id,
+            "asset_id": asset["id"],
             "playback_id": playback_id,
             "playback_url": f"https://stream.mux.com/{playback_id}.m3u8",
-            "status": asset.data.status
+            "status": asset["status"]
         }
         log(f"Full Mux response data: {json.dumps(response_data, indent=2)}")
         
         return response_data
-    except ApiException as e:
-        log(f"❌ Mux API error: {str(e)}")
+    except httpx.HTTPStatusError as e:
+        log(f"❌ Mux API error: {e.response.status_code} {e.response.text}")
         raise
     except Exception as e:
         log(f"❌ Unexpected error during Mux upload: {str(e)}")
         raise
 
-def main():
+async def main():
     """Main function to test Mux upload."""
     log("🚀 Starting Mux upload test")
     start_time = time.time()
@@ -191,14 +201,18 @@ def main():
         log(f"Found merged video: {video_path.absolute()}")
         
         # Upload to Mux
-        mux_response = upload_to_mux(str(video_path.absolute()))
+        mux_response = await upload_to_mux(str(video_path.absolute()))
         
         # Calculate total processing time
         total_time = time.time() - start_time
         log(f"✨ Process completed successfully in {total_time:.2f} seconds")
         
+        if "playback_url" not in mux_response:
+            log(f"\n📨 Upload {mux_response['upload_id']} is processing (passthrough {mux_response['passthrough']})")
+            return
+        
         # Print final playback URL
-        log("\n🎬 Your video is ready!")
+        log(f"\n🎬 Your video is {'ready' if mux_response['status'] == 'ready' else 'processing'}!")
         log(f"Playback URL: {mux_response['playback_url']}")
         log(f"Asset ID: {mux_response['asset_id']}")
         log(f"Playback ID: {mux_response['playback_id']}")
@@ -206,6 +220,8 @@ def main():
     except Exception as e:
         log(f"❌ Process failed: {str(e)}")
         raise
+    finally:
+        await MUX_CLIENT.aclose()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    asyncio.run(main()) 
\ No newline at end of file
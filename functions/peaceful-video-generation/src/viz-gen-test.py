@@ -1,50 +1,59 @@
 import os
-import json
+import orjson
 import time
 import asyncio
-from datetime import datetime
-from dotenv import load_dotenv
+import uuid
+from datetime import datetime, timezone
 from appwrite.client import Client
 from appwrite.services.databases import Databases
+from appwrite.exception import AppwriteException
 import replicate
+from common import REPLICATE_WEBHOOK_SECRET, verify_replicate_signature, error_response
 
-# Load environment variables
-load_dotenv()
+# Initialize Appwrite once per container from the function environment
+client = Client()
+client.set_endpoint('https://cloud.appwrite.io/v1')
+client.set_project(os.getenv('APPWRITE_FUNCTION_PROJECT_ID', ''))
+client.set_key(os.getenv('APPWRITE_FUNCTION_API_KEY', ''))
+databases = Databases(client)
 
-# Initialize Appwrite (using function context)
-client = None
-databases = None
-
-def init_appwrite(context):
-    """Initialize Appwrite client with function context."""
-    global client, databases
-    client = Client()
-    
-    # Log available environment info
-    context.log("Available environment variables:")
-    context.log(str(dir(context)))
-    
-    # Initialize with function environment
-    client.set_endpoint('https://cloud.appwrite.io/v1')
-    client.set_project(os.getenv('APPWRITE_FUNCTION_PROJECT_ID', ''))
-    client.set_key(os.getenv('APPWRITE_FUNCTION_API_KEY', ''))
-    databases = Databases(client)
+# Request header dumps are only built when LOG_LEVEL=DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Headers left out of debug dumps
+SENSITIVE_HEADERS = {"authorization", "cookie", "x-appwrite-key", "x-appwrite-user-jwt"}
 
 # Constants
 DATABASE_ID = "67a580230029e01e56af"
 COLLECTION_ID = "67acf64500037ab9c429"  # viz-generation-jobs collection
 
+# Replicate client, built once per container so warm invocations reuse its
+# keep-alive connections to api.replicate.com
+REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
+REPLICATE = replicate.Client(api_token=REPLICATE_API_TOKEN)
+
+# Public URL of this function. When set, predictions are created with a
+# completion webhook that calls back into /replicate-callback instead of being
+# awaited in a background task
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL", "")
+
 def safe_json_dumps(obj):
     """Safely convert object to JSON string."""
-    return json.dumps(obj, indent=2, default=str)
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2, default=str).decode()
+
+# Input parameters for Luma Ray are the same for every request, so build them
+# and their logged form once
+VIZ_INPUT = {
+    "prompt": "beautiful abstract peaceful animation, soft flowing colors, gentle transitions, meditative visuals"
+}
+VIZ_INPUT_JSON = safe_json_dumps(VIZ_INPUT)
 
 async def generate_visualization(context, input_params):
     """Async function to generate visualization using Luma Ray."""
     try:
         # Log the API token status
-        context.log(f"Using Replicate API token: {'Present' if os.getenv('REPLICATE_API_TOKEN') else 'Missing'}")
+        context.log(f"Using Replicate API token: {'Present' if REPLICATE_API_TOKEN else 'Missing'}")
         
-        return replicate.run(
+        return await REPLICATE.async_run(
             "luma/ray",
             input=input_params
         )
@@ -54,38 +63,62 @@ async def generate_visualization(context, input_params):
         context.error(f"Full error details: {str(e)}")
         raise
 
-def create_job_document(prompt):
-    """Create a new job document in Appwrite."""
+def create_job_document(job_id, prompt, data, created_at):
+    """Write a job's document in Appwrite once, with its final state; returns None if it already exists."""
     try:
         return databases.create_document(
             database_id=DATABASE_ID,
             collection_id=COLLECTION_ID,
-            document_id='unique()',
+            document_id=job_id,
             data={
-                'status': 'processing',
+                **data,
                 'prompt': prompt,
-                'created_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat()
+                'created_at': created_at,
+                'updated_at': datetime.now(timezone.utc).isoformat()
             }
         )
+    except AppwriteException as e:
+        if e.code == 409:
+            return None
+        raise Exception(f"Failed to create job document: {str(e)}")
     except Exception as e:
         raise Exception(f"Failed to create job document: {str(e)}")
 
-def update_job_document(job_id, data):
-    """Update an existing job document in Appwrite."""
-    try:
-        data['updated_at'] = datetime.now().isoformat()
-        return databases.update_document(
-            database_id=DATABASE_ID,
-            collection_id=COLLECTION_ID,
-            document_id=job_id,
-            data=data
-        )
-    except Exception as e:
-        raise Exception(f"Failed to update job document: {str(e)}")
+async def handle_replicate_callback(context):
+    """Record a finished prediction on its job document when Replicate calls back."""
+    if not verify_replicate_signature(context.req.headers, context.req.bodyText):
+        return error_response(context, "Invalid signature", 401)
+    
+    job_id = context.req.query.get("job_id")
+    if not job_id:
+        return error_response(context, "Missing job_id", 400)
+    prediction = orjson.loads(context.req.bodyText)
+    execution_time = (prediction.get("metrics") or {}).get("predict_time", 0)
+    
+    if prediction["status"] == "succeeded":
+        data = {
+            'status': 'completed',
+            'output_url': str(prediction["output"]),  # Luma Ray returns a single URL string
+            'execution_time_seconds': round(execution_time, 2)
+        }
+    else:
+        data = {
+            'status': 'failed',
+            'error': f"Prediction {prediction['status']}: {prediction.get('error')}",
+            'execution_time_seconds': round(execution_time, 2)
+        }
+    document = await asyncio.to_thread(create_job_document, job_id, prediction["input"]["prompt"], data,
+                                       prediction["created_at"])
+    if document is None:
+        # A redelivered callback; the first delivery already wrote the job
+        context.log(f"♻️ Job {job_id} already recorded, ignoring redelivery")
+        return context.res.json({"success": True})
+    context.log(f"✅ Recorded {prediction['status']} prediction {prediction['id']} on job {job_id}")
+    return context.res.json({"success": True})
 
 async def process_visualization_generation(context, job_id, input_params, start_time):
-    """Process visualization generation in the background."""
+    """Run a visualization job to completion and record it; returns the final status."""
+    created_at = datetime.fromtimestamp(start_time, timezone.utc).isoformat()
     try:
         # Start visualization generation
         context.log("🎬 Starting visualization generation")
@@ -94,95 +127,101 @@ async def process_visualization_generation(context, job_id, input_params, start_
         # Calculate execution time
         execution_time = time.time() - start_time
         
-        # Log the output type and structure
-        context.log(f"Output type: {type(output)}")
-        context.log(f"Output value: {str(output)}")
+        # Log the output type and structure, as a single line
+        if LOG_LEVEL == "DEBUG":
+            context.log(f"Output ({type(output).__name__}): {output}")
         
-        # Update job with success
-        update_job_document(job_id, {
+        # Record the finished job
+        await asyncio.to_thread(create_job_document, job_id, input_params['prompt'], {
             'status': 'completed',
             'output_url': str(output),  # Luma Ray returns a single URL string
             'execution_time_seconds': round(execution_time, 2)
-        })
+        }, created_at)
         
         context.log(f"✅ Job completed successfully in {execution_time:.2f} seconds")
+        return 'completed'
         
     except Exception as e:
-        # Update job with error
+        # Record the failed job
         error_msg = f"{type(e).__name__}: {str(e)}"
-        update_job_document(job_id, {
+        await asyncio.to_thread(create_job_document, job_id, input_params['prompt'], {
             'status': 'failed',
             'error': error_msg,
             'execution_time_seconds': round(time.time() - start_time, 2)
-        })
+        }, created_at)
         context.error(f"❌ Job failed: {error_msg}")
+        return 'failed'
 
 async def main(context):
     """Main function handler for visualization generation."""
     start_time = time.time()
     context.log("🎯 Test function entry point reached")
     
-    # Initialize Appwrite
-    init_appwrite(context)
-    context.log("✅ Initialized Appwrite client")
-    
-    # Log request details
-    context.log(f"Request method: {context.req.method}")
-    context.log(f"Request path: {context.req.path}")
-    context.log(f"Request headers: {safe_json_dumps(dict(context.req.headers))}")
+    # Replicate completion callbacks
+    if context.req.path == "/replicate-callback":
+        return await handle_replicate_callback(context)
     
     # Handle non-API requests
     if context.req.path and context.req.path != "/":
-        return context.res.json({
-            "success": False,
-            "error": "Invalid endpoint. Please use the root path '/' for visualization generation.",
-            "path": context.req.path
-        }, 404)
+        return error_response(context, "Invalid endpoint. Please use the root path '/' for visualization generation.",
+                              404, start_time=start_time, path=context.req.path)
     
     # Check environment variables
-    if not os.getenv('REPLICATE_API_TOKEN'):
+    if not REPLICATE_API_TOKEN:
         error_msg = "Missing REPLICATE_API_TOKEN environment variable"
         context.error(f"❌ {error_msg}")
-        return context.res.json({
-            "success": False,
-            "error": error_msg
-        }, 500)
+        return error_response(context, error_msg, start_time=start_time)
     
+    # Callbacks are refused without the signing secret, so don't start jobs that could never be recorded
+    if REPLICATE_WEBHOOK_URL and not REPLICATE_WEBHOOK_SECRET:
+        error_msg = "REPLICATE_WEBHOOK_URL is set without REPLICATE_WEBHOOK_SECRET"
+        context.error(f"❌ {error_msg}")
+        return error_response(context, error_msg, start_time=start_time)
+
     context.log("✅ Found Replicate API token")
     
+    # Log request details once the request is known to be served
+    context.log(f"Request method: {context.req.method}")
+    context.log(f"Request path: {context.req.path}")
+    if LOG_LEVEL == "DEBUG":
+        context.log(f"Request headers: {safe_json_dumps({k: v for k, v in context.req.headers.items() if k.lower() not in SENSITIVE_HEADERS})}")
+    
     try:
-        # Prepare input parameters for Luma Ray
-        input_params = {
-            "prompt": "beautiful abstract peaceful animation, soft flowing colors, gentle transitions, meditative visuals",
-            "negative_prompt": "text, watermark, ugly, distorted, noisy",
-            "fps": 30,
-            "num_frames": 90,  # 3 seconds at 30fps
-            "guidance_scale": 7.5,
-            "num_inference_steps": 50,
-            "width": 512,
-            "height": 512,
-            "scheduler": "DPM++ Karras SDE"
-        }
-        context.log(f"Input parameters: {safe_json_dumps(input_params)}")
+        input_params = VIZ_INPUT
+        context.log(f"Input parameters: {VIZ_INPUT_JSON}")
         
-        # Create job document
-        job = create_job_document(input_params['prompt'])
-        job_id = job['$id']
-        context.log(f"✅ Created job document with ID: {job_id}")
+        # The job's document is written once, when it finishes, under an ID
+        # picked here so it can be returned straight away
+        job_id = uuid.uuid4().hex[:20]
+        context.log(f"✅ Assigned job ID: {job_id}")
         
-        # Start background processing
-        asyncio.create_task(process_visualization_generation(context, job_id, input_params, start_time))
+        if REPLICATE_WEBHOOK_URL:
+            # Hand the wait to Replicate: it posts the finished prediction back
+            # to /replicate-callback, so nothing stays running here
+            prediction = await REPLICATE.models.predictions.async_create(
+                model="luma/ray",
+                input=input_params,
+                webhook=f"{REPLICATE_WEBHOOK_URL}/replicate-callback?job_id={job_id}",
+                webhook_events_filter=["completed"]
+            )
+            context.log(f"🚀 Started prediction {prediction.id}")
+            return context.res.json({
+                "success": True,
+                "message": "Visualization generation job created",
+                "job_id": job_id,
+                "prediction_id": prediction.id
+            })
         
-        # Return job ID immediately
+        # Without a webhook, wait for the job here. A task left running after
+        # main returns is cut off when the runtime freezes or recycles the
+        # container, leaving the job unrecorded.
+        status = await process_visualization_generation(context, job_id, input_params, start_time)
         return context.res.json({
-            "success": True,
-            "message": "Visualization generation job created",
+            "success": status == 'completed',
+            "message": f"Visualization generation job {status}",
             "job_id": job_id
         })
             
     except Exception as e:
         context.error(f"❌ Setup error: {str(e)}")
-        return context.res.json({
-            "success": False,
-            "error": str(e)
-        }, 500) 
\ No newline at end of file
+        return error_response(context, e, start_time=start_time) 
\ No newline at end of file
@@ -1,11 +1,15 @@
 import os
+import json
 from appwrite.client import Client
 from appwrite.exception import AppwriteException
 from appwrite.services.users import Users
 
+# The response never changes, so encode it once at import
+HELLO_BODY = json.dumps({
+    "message": "Hello from Appwrite Function!",
+    "status": "success"
+})
+
 def main(context):
     # Simple test response
-    return context.res.json({
-        "message": "Hello from Appwrite Function!",
-        "status": "success"
-    }) 
\ No newline at end of file
+    return context.res.send(HELLO_BODY, 200, {"content-type": "application/json"})